@@ -1,13 +1,31 @@
+import gzip
+import json
 import os
 import uuid
 from datetime import datetime
+from functools import lru_cache
 
-from flask import request, Flask, jsonify
+from flask import request, Flask, jsonify, Response
 from flask_cors import cross_origin
 from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 
-from main.requests_util import request_coordinates_remote
-from main.worker.job import run_job
+from main.events import subscribe, event_stream
+from main.export import to_geojson, to_gpx
+from main.geocoding import LruGeocodeCache, RedisGeocodeCache
+from main.presolve import check_structure, InfeasibleConstraints
+from main.profiling import load_profile, summarize, SORT_KEYS
+from main.progress import request_stop
+from main.requests_util import make_coordinates_geocoder
+from main.result_store import RESULT_TTL, load_etag, load_response_body, load_routes, load_export
+from main.scheduling import SOLVER_QUEUES, QUICK_QUEUE, MAX_ACTIVE_JOBS_PER_RECIPIENT, RUN_MAIL_JOB, queue_name, \
+    active_job_ids, add_active_job, estimated_wait, enqueue_mail
+from main.submission import instance_hash, find_job_id, remember_job_id
+from main.telemetry import metrics_text
+from main.template import render_combined
+from main.util import transform_to_index_value_format
+from main.warm_start import remap_routes, address_identity
 from main.worker.worker import conn
 
 app = Flask(__name__, instance_relative_config=True, static_folder='../build', static_url_path='')
@@ -15,6 +33,19 @@ app = Flask(__name__, instance_relative_config=True, static_folder='../build', s
 config_file = os.environ.get('CONFIG_FILE')
 app.config.from_pyfile(config_file)
 q = Queue(connection=conn)
+solver_queues = dict((name, Queue(name, connection=conn)) for name in SOLVER_QUEUES)
+geocode_cache = LruGeocodeCache(RedisGeocodeCache(conn))
+
+GEOCODE_SYNC_LIMIT = int(os.environ.get('GEOCODE_SYNC_LIMIT', 3))
+PAYLOAD_RECORD_DIR = os.environ.get('PAYLOAD_RECORD_DIR')
+REPLAN_IMPROVE_TIMEOUT = int(os.environ.get('REPLAN_IMPROVE_TIMEOUT', 5))
+TEMPLATE_HTML = './main/templates/template.html'
+COMBINED_TEMPLATE_HTML = './main/templates/routes.html'
+EXPORT_MIMETYPES = {'geojson': 'application/geo+json', 'gpx': 'application/gpx+xml', 'html': 'text/html'}
+# jobs are enqueued by name, so the web processes never import ortools and the solver modules
+RUN_JOB = 'main.worker.job.run_job'
+RUN_REPLAN_JOB = 'main.worker.job.run_replan_job'
+RUN_GEOCODE_JOB = 'main.worker.geocode_job.run_geocode_job'
 
 MAIL_KEYS = ['MAIL_SERVER', 'MAIL_PORT', 'MAIL_USERNAME', 'MAIL_PASSWORD', 'MAIL_USE_SSL',
              'MAIL_USE_TLS', 'MAIL_TYPE', 'MAP_API_KEY']
@@ -24,15 +55,41 @@ MAIL_KEYS = ['MAIL_SERVER', 'MAIL_PORT', 'MAIL_USERNAME', 'MAIL_PASSWORD', 'MAIL
 @cross_origin()
 def coordinates():
     data = request.args
-    config = make_config()
-    api_key = config.get("MAP_API_KEY")
+    address = dict((key, data[key]) for key in ['code', 'address', 'country', 'locality'])
+    geocoder = coordinates_geocoder()
+    coordinates_list, errors = geocoder.geocode_all([address])
+    if coordinates_list[0]:
+        return coordinates_list[0]
+    return {'error_message': errors.get(geocoder.key(address), 'not found')}
+
 
-    json = request_coordinates_remote(api_key, data['code'], data['address'], data['country'], data['locality'])
-    features_ = json['features']
-    if len(features_) <= 0:
-        return {}
-    coords_result = features_[0]['geometry']['coordinates']
-    return {'lat': coords_result[1], 'lon': coords_result[0]}
+@app.route("/coordinates/batch", methods=["POST"])
+@cross_origin()
+def coordinates_batch():
+    """
+    Geocodes a list of addresses with keys code, address, country and locality. Returns coordinates, or {} if not
+    found, in input order. Lists with more than GEOCODE_SYNC_LIMIT addresses missing in the cache are geocoded in a
+    job, poll its id via GET, the rate limited lookups would hold a web thread for seconds.
+    """
+    addresses = request.get_json()['addresses']
+    geocoder = coordinates_geocoder()
+    if geocoder.uncached(addresses) > GEOCODE_SYNC_LIMIT:
+        job = q.enqueue_call(func=RUN_GEOCODE_JOB, args=(addresses, map_api_key()), result_ttl=5000)
+        return jsonify(get_status(job))
+
+    coordinates_list, _ = geocoder.geocode_all(addresses)
+    return jsonify({'id': None, 'status': 'completed',
+                    'result': [coordinates or {} for coordinates in coordinates_list]})
+
+
+@app.route("/coordinates/batch", methods=["GET"])
+@cross_origin()
+def check_coordinates_batch():
+    query_id = request.args.get('job')
+    found_job = fetch_job(query_id) if query_id else None
+    if not found_job:
+        return {'id': None, 'error_message': 'No job exists with the id number ' + str(query_id)}
+    return get_status(found_job)
 
 
 @app.route("/vrp", methods=["GET"])
@@ -40,11 +97,12 @@ def coordinates():
 def check_job():
     query_id = request.args.get('job')
     if query_id:
-        found_job = q.fetch_job(query_id)
+        etag = load_etag(conn, query_id)
+        if etag:
+            return completed_response(query_id, etag)
+        found_job = fetch_job(query_id)
         if found_job:
             output = get_status(found_job)
-            if 'result' in output:
-                output['result']['routes'] = flatten_route_lists(output['result']['routes'])
         else:
             output = {'id': None, 'error_message': 'No job exists with the id number ' + query_id}
         return output
@@ -59,17 +117,170 @@ def create_job():
     config = make_config()
     api_key = config.get("MAP_API_KEY")
     print("-----> Create Job " + api_key)
+    if PAYLOAD_RECORD_DIR:
+        record_payload(data)
     constraints_json = data['constraints']
     transform_to_index_value_format(constraints_json, 'dwell_duration')
     transform_to_index_value_format(constraints_json, 'time_windows')
+    try:
+        check_structure(constraints_json)
+    except InfeasibleConstraints as e:
+        return {'id': None, 'error_message': str(e), 'infeasible': e.reasons}
+    add_initial_routes(constraints_json, data.get('warm_start_job'), data['data'])
+
+    instance = instance_hash(data['data'], constraints_json)
+    existing_job = reusable_job(instance) if data.get('reuse', True) else None
+    if existing_job:
+        reused = 'completed' if load_etag(conn, existing_job.id) else 'in_flight'
+        if existing_job.args[3] != data['recipent']:
+            mail_routes_of(existing_job, config, data['recipent'], constraints_json['planningType'])
+        return jsonify(dict(get_status(existing_job), reused=reused))
+
+    limit_error = active_jobs_limit_error(data['recipent'])
+    if limit_error:
+        return limit_error, 429
+
     alive_time = constraints_json['timeout'] * 2
-    job = q.enqueue_call(func=run_job,
-                         args=(data['data'], constraints_json, config, data['recipent'], api_key,
-                               './main/templates/template.html'), result_ttl=5000, ttl=None, timeout=alive_time)
+    solver_queue = solver_queues[queue_name(len(data['data']), constraints_json['timeout'])]
+    job = solver_queue.enqueue_call(func=RUN_JOB,
+                                    args=(data['data'], constraints_json, config, data['recipent'], api_key,
+                                          TEMPLATE_HTML), result_ttl=RESULT_TTL, ttl=None, timeout=alive_time)
+    remember_job_id(conn, instance, job.id)
+    add_active_job(conn, data['recipent'], job.id)
 
     return jsonify(get_status(job))
 
 
+@app.route("/vrp/replan", methods=["POST"])
+@cross_origin()
+def replan_job():
+    """
+    Adds the addresses in data to the routes of the completed job, keeping its constraints. Only the matrix rows and
+    columns of the new addresses are fetched, the new stops are inserted at their cheapest feasible positions and
+    the routes they went to are improved for improve_timeout seconds, 0 to skip. Addresses already planned are
+    ignored. The result is a new job, which can be re-planned in turn.
+    """
+    data = request.get_json()
+    previous_job = fetch_job(data['job']) if data.get('job') else None
+    previous_routes = load_routes(conn, previous_job.id) if previous_job else None
+    if not previous_routes:
+        return {'id': None, 'error_message': 'No completed job exists with the id number ' + str(data.get('job'))}
+    addresses, constraints_json = previous_job.args[0], dict(previous_job.args[1])
+    planned = set(address_identity(address) for address in addresses)
+    new_addresses = list(dict((address_identity(address), address) for address in data['data']
+                              if address_identity(address) not in planned).values())
+    if not new_addresses:
+        return jsonify(dict(get_status(previous_job), new_stops=0))
+
+    recipient = data.get('recipent', previous_job.args[3])
+    limit_error = active_jobs_limit_error(recipient)
+    if limit_error:
+        return limit_error, 429
+
+    all_addresses = addresses + new_addresses
+    new_nodes = list(range(len(addresses), len(all_addresses)))
+    constraints_json['initial_routes'] = remap_routes(previous_routes, all_addresses, constraints_json['depot'])
+    improve_timeout = int(data.get('improve_timeout', REPLAN_IMPROVE_TIMEOUT))
+    config = make_config()
+    job = solver_queues[QUICK_QUEUE].enqueue_call(
+        func=RUN_REPLAN_JOB, args=(all_addresses, constraints_json, config, recipient, config.get("MAP_API_KEY"),
+                                   TEMPLATE_HTML, new_nodes, improve_timeout),
+        result_ttl=RESULT_TTL, ttl=None, timeout=max(60, improve_timeout * 4))
+    add_active_job(conn, recipient, job.id)
+
+    return jsonify(dict(get_status(job), new_stops=len(new_nodes)))
+
+
+@app.route("/vrp/events", methods=["GET"])
+@cross_origin()
+def job_events():
+    """
+    Server-sent events of the job: its current status first, then 'meta', 'progress' and 'status' events as the
+    worker publishes them, until the job completed or failed. Completed jobs are fetched once with GET /vrp.
+    """
+    query_id = request.args.get('job')
+    found_job = fetch_job(query_id) if query_id else None
+    if not found_job:
+        return {'id': None, 'error_message': 'No job exists with the id number ' + str(query_id)}
+    pubsub = subscribe(conn, found_job.id)
+    if load_etag(conn, found_job.id):
+        initial_events = [('status', {'id': found_job.id, 'status': 'completed'})]
+    else:
+        initial_events = [('status', get_status(found_job))]
+    return Response(event_stream(pubsub, initial_events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route("/vrp/stop", methods=["POST"])
+@cross_origin()
+def stop_job():
+    """Ends the search of a running job early, the job completes with the best solution found so far."""
+    query_id = request.args.get('job')
+    found_job = fetch_job(query_id) if query_id else None
+    if not found_job:
+        return {'id': None, 'error_message': 'No job exists with the id number ' + str(query_id)}
+    request_stop(conn, found_job.id)
+    return get_status(found_job)
+
+
+@app.route("/vrp/profile", methods=["GET"])
+@cross_origin()
+def job_profile():
+    """Top functions of a profiled job, ?sort=cumulative|tottime|calls&top=N; ?format=pstats returns the dump for
+    pstats or snakeviz."""
+    query_id = request.args.get('job')
+    profile = load_profile(conn, query_id) if query_id else None
+    if not profile:
+        return {'id': None, 'error_message': 'No profile exists for the job id ' + str(query_id)}
+    if request.args.get('format') == 'pstats':
+        return Response(profile, mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=' + query_id + '.pstats'})
+    top = request.args.get('top', '20')
+    sort = request.args.get('sort', 'cumulative')
+    if not top.isdigit():
+        return {'id': query_id, 'error_message': 'top has to be a number of functions, not ' + top}
+    if sort not in SORT_KEYS:
+        return {'id': query_id, 'error_message': 'sort has to be one of ' + ', '.join(SORT_KEYS)}
+    return dict(summarize(profile, int(top), sort), id=query_id)
+
+
+@app.route("/vrp/export", methods=["GET"])
+@cross_origin()
+def job_export():
+    """The routes of a completed job as ?format=geojson, gpx or printable html, ?route=i for a single gpx route.
+    Every export is built on its first request and kept with the result."""
+    query_id = request.args.get('job')
+    export_format = request.args.get('format', 'geojson')
+    found_job = fetch_job(query_id) if query_id else None
+    if not found_job or export_format not in EXPORT_MIMETYPES:
+        return {'id': None, 'error_message': 'No {} export exists for the job id {}'.format(export_format, query_id)}
+    route = request.args.get('route')
+    if route is not None and export_format != 'gpx':
+        return {'id': query_id, 'error_message': 'Single routes are exported as gpx only'}
+    if route is not None and not route.isdigit():
+        return {'id': query_id, 'error_message': 'No route ' + route}
+    route = None if route is None else int(route)
+    name = export_format if route is None else 'gpx:' + str(route)
+    planning_type = found_job.args[1]['planningType']
+    try:
+        export = load_export(conn, found_job.id, name, lambda routes: build_export(export_format, routes,
+                                                                                      planning_type, route))
+    except IndexError:
+        return {'id': query_id, 'error_message': 'No route ' + str(route)}
+    if export is None:
+        return {'id': query_id, 'error_message': 'The job has no result yet'}
+    file_name = query_id + ('' if route is None else '-' + str(route)) + '.' + export_format
+    return Response(export, mimetype=EXPORT_MIMETYPES[export_format],
+                    headers={'Content-Disposition': 'inline; filename=' + file_name})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Job, phase and solver metrics in the Prometheus text format."""
+    queue_length = q.count + sum(queue.count for queue in solver_queues.values())
+    return Response(metrics_text(conn, {'vrp_queue_length': queue_length}), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/', methods=["GET"])
 @cross_origin()
 def index():
@@ -82,6 +293,18 @@ def favicon():
     return app.send_static_file('favicon.ico')
 
 
+@lru_cache(maxsize=1)
+def map_api_key():
+    return make_config().get("MAP_API_KEY")
+
+
+@lru_cache(maxsize=1)
+def coordinates_geocoder():
+    """One geocoder per process, so concurrent requests share its rate limit and connection pool."""
+    return make_coordinates_geocoder(map_api_key(), geocode_cache)
+
+
+@lru_cache(maxsize=1)
 def make_config():
     config = dict((k, app.config[k]) for k in MAIL_KEYS if k in app.config)
     config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
@@ -95,25 +318,92 @@ def make_config():
 
 
 def get_status(job):
+    failed = job.is_failed or job.meta.get('status') == 'failed'
     status = {
         'id': job.id,
         'result': job.result,
-        'status': 'failed' if job.is_failed else 'pending' if job.result == None else 'completed'
+        'status': 'failed' if failed else 'pending' if job.result == None else 'completed'
     }
     status.update(job.meta)
+    status['queue'] = job.origin
+    wait = estimated_wait(conn, job) if job.is_queued else None
+    if wait is not None:
+        status['estimated_wait_seconds'] = wait
     return status
 
 
-def transform_to_index_value_format(constrains_json, tag):
-    dwell_duration = constrains_json[tag]
-    constrains_json[tag] = dict([item.values() for item in dwell_duration])
+def record_payload(data):
+    """Keeps the /vrp payload without recipient as json in PAYLOAD_RECORD_DIR, for replay by main.benchmark.solver."""
+    record = dict((key, value) for key, value in data.items() if key != 'recipent')
+    file_name = datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8] + '.json'
+    with open(os.path.join(PAYLOAD_RECORD_DIR, file_name), 'w') as outfile:
+        json.dump(record, outfile)
 
 
-def flatten_route_lists(result_data):
-    for idx, route in enumerate(result_data):
-        for route_item in route:
-            route_item['idx'] = idx
-    return [val for sublist in result_data for val in sublist]
+def fetch_job(job_id):
+    """The job with job_id from any of the queues, None if there is none."""
+    try:
+        return Job.fetch(job_id, connection=conn)
+    except NoSuchJobError:
+        return None
+
+
+def active_jobs_limit_error(recipient):
+    """The error response if recipient has MAX_ACTIVE_JOBS_PER_RECIPIENT jobs queued or running, None otherwise."""
+    active_jobs = active_job_ids(conn, recipient)
+    if len(active_jobs) < MAX_ACTIVE_JOBS_PER_RECIPIENT:
+        return None
+    return {'id': None, 'active_jobs': active_jobs,
+            'error_message': 'There are already {} jobs queued or running for {}'.format(len(active_jobs), recipient)}
+
+
+def reusable_job(instance):
+    """The queued, running or successfully completed job of an identical request within the reuse window."""
+    job_id = find_job_id(conn, instance)
+    job = fetch_job(job_id) if job_id else None
+    if not job or job.is_failed or (job.is_finished and not load_etag(conn, job.id)):
+        return None
+    return job
+
+
+def mail_routes_of(job, config, mail_to, planning_type):
+    """Mails the routes of job to mail_to once they are stored, right away if the job completed already."""
+    enqueue_mail(conn, RUN_MAIL_JOB, (job.id, config, mail_to, planning_type, TEMPLATE_HTML),
+                 depends_on=None if job.is_finished else job)
+
+
+def add_initial_routes(constraints_json, previous_job_id, addresses):
+    """Passes the routes of a completed earlier job, remapped to the current addresses, as start for the solver."""
+    previous_routes = load_routes(conn, previous_job_id) if previous_job_id else None
+    if previous_routes:
+        constraints_json['initial_routes'] = remap_routes(previous_routes, addresses, constraints_json['depot'])
+
+
+def build_export(export_format, routes, planning_type, route=None):
+    """The export of the routes, only the route with index route of a gpx export unless it is None."""
+    if export_format == 'geojson':
+        return to_geojson(routes)
+    if export_format == 'gpx':
+        if route is not None and not 0 <= route < len(routes):
+            raise IndexError(route)
+        return to_gpx(routes, None if route is None else [route])
+    return render_combined(routes, COMBINED_TEMPLATE_HTML, planning_type)
+
+
+def completed_response(job_id, etag):
+    """The stored response of a completed job, 304 if the client has it already, gzipped if the client accepts it."""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        body = load_response_body(conn, job_id)
+        if 'gzip' in request.accept_encodings:
+            response = Response(body, mimetype='application/json', headers={'Content-Encoding': 'gzip'})
+        else:
+            response = Response(gzip.decompress(body), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+"""Measures the cold start of the web app and of a worker, and which heavy modules each of them imports.
+
+The web app is imported with a fresh interpreter per repeat. The worker is measured twice: preloading the solver stack
+as main.worker.pool does, and the import of main.worker.job in a work horse forked after that preload, which is what
+a job pays before it starts.
+
+Usage: python -m main.benchmark.cold_start [repeats]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['ortools', 'sendgrid', 'numpy', 'main.run_algorithm', 'main.worker.job']
+
+WEB = """
+import json, sys, time
+start = time.time()
+import main.app
+print(json.dumps({'seconds': time.time() - start, 'modules': [m for m in HEAVY if m in sys.modules]}))
+"""
+
+WORKER = """
+import json, os, sys, time
+from main.worker.pool import preload
+seconds = preload()
+read, write = os.pipe()
+if os.fork() == 0:
+    start = time.time()
+    import main.worker.job
+    os.write(write, str(time.time() - start).encode())
+    os._exit(0)
+os.wait()
+horse = float(os.read(read, 64))
+print(json.dumps({'seconds': seconds, 'horse_seconds': horse, 'modules': [m for m in HEAVY if m in sys.modules]}))
+"""
+
+
+def measure(script):
+    env = dict(os.environ, CONFIG_FILE=os.environ.get('CONFIG_FILE', 'prod.cfg'))
+    output = subprocess.run([sys.executable, '-c', 'HEAVY = {!r}\n'.format(HEAVY_MODULES) + script], env=env,
+                            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def report(name, runs):
+    line = "{:<8} median {:.3f}s  max {:.3f}s".format(name, statistics.median(run['seconds'] for run in runs),
+                                                       max(run['seconds'] for run in runs))
+    if 'horse_seconds' in runs[0]:
+        line += "  horse {:.4f}s".format(statistics.median(run['horse_seconds'] for run in runs))
+    print(line + "  loads " + (', '.join(runs[0]['modules']) or '-'))
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    report('web', [measure(WEB) for _ in range(repeats)])
+    report('worker', [measure(WORKER) for _ in range(repeats)])
@@ -0,0 +1,85 @@
+"""Local stand-in for the ORS matrix API and the OSRM table service, answering with walking durations.
+
+Usage: python -m main.benchmark.fake_matrix_server [port]
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+from main.benchmark.instances import walking_duration
+
+ORS_PATH = '/v2/matrix/'
+OSRM_PATH = '/table/v1/walking/'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MatrixHandler(BaseHTTPRequestHandler):
+    max_locations = 100
+    fail_every = 0  # answer every n-th request with 503 to exercise retries
+    retry_after = None  # if set, failures are 429 answers with this Retry-After header instead
+    latency = 0.0  # seconds added to every answer, mimicking the routing backend
+    requests_served = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        if not self.path.startswith(ORS_PATH):
+            return self.send_error(404)
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        points = [(lat, lon) for lon, lat in body['locations']]
+        self.answer(points, body.get('sources'), body.get('destinations'))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith(OSRM_PATH):
+            return self.send_error(404)
+        coordinates = url.path[len(OSRM_PATH):].split(';')
+        points = [tuple(reversed([float(value) for value in coordinate.split(',')])) for coordinate in coordinates]
+        query = parse_qs(url.query)
+        sources = [int(i) for i in query['sources'][0].split(';')] if 'sources' in query else None
+        destinations = [int(i) for i in query['destinations'][0].split(';')] if 'destinations' in query else None
+        self.answer(points, sources, destinations)
+
+    def answer(self, points, sources, destinations):
+        with self.lock:
+            MatrixHandler.requests_served += 1
+            served = MatrixHandler.requests_served
+        time.sleep(self.latency)
+        if self.fail_every and served % self.fail_every == 0:
+            if self.retry_after is None:
+                return self.send_error(503)
+            self.send_response(429)
+            self.send_header('Retry-After', str(self.retry_after))
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        if len(points) > self.max_locations:
+            return self.send_error(413)
+        sources = range(len(points)) if sources is None else sources
+        destinations = range(len(points)) if destinations is None else destinations
+        durations = [[walking_duration(points[i], points[j]) for j in destinations] for i in sources]
+        payload = json.dumps({'durations': durations}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0):
+    """Serves in a daemon thread and returns the server, its base url is http://127.0.0.1:server.server_port"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), MatrixHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    ThreadingHTTPServer(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 5000), MatrixHandler).serve_forever()
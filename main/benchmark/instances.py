@@ -0,0 +1,104 @@
+"""Synthetic and recorded instances in the format of the /vrp payload."""
+import json
+import math
+import random
+
+from main.util import transform_to_index_value_format
+
+WALKING_SPEED = 1.3  # m/s
+DEPOT = (48.93, 9.02)
+BLOCK = 0.0008  # degrees between parallel streets, ~60-90m
+
+
+def random_instance(no_nodes, num_vehicles=3, timeout=10, seed=0):
+    """Returns dist_matrix, constraints and addresses of uniformly scattered stops around a depot."""
+    rnd = random.Random(seed)
+    points = [(48.93 + rnd.uniform(-0.01, 0.01), 9.02 + rnd.uniform(-0.015, 0.015)) for _ in range(no_nodes)]
+    return make_instance(points, num_vehicles, timeout)
+
+
+def street_grid_instance(no_nodes, num_vehicles=3, clusters=3, timeout=10, time_windows=0.0, same_route=0,
+                         assign_to_route=0, fixed_arcs=0, seed=0):
+    """
+    Stops on the streets of clustered grids around the depot, like the quarters of a small town; every fifth stop
+    shares its building with the previous one. time_windows is the fraction of stops with a four hour window,
+    same_route, assign_to_route and fixed_arcs are the number of pairs, stops and three stop chains.
+    """
+    rnd = random.Random(seed)
+    centers = [(DEPOT[0] + rnd.uniform(-0.01, 0.01), DEPOT[1] + rnd.uniform(-0.015, 0.015)) for _ in range(clusters)]
+    points = [DEPOT]
+    while len(points) < no_nodes:
+        if len(points) % 5 == 0:
+            points.append(points[-1])
+            continue
+        lat, lon = rnd.choice(centers)
+        street, along = rnd.randint(-5, 5) * BLOCK, rnd.uniform(-5, 5) * BLOCK
+        points.append((lat + street, lon + along * 1.5) if rnd.random() < 0.5 else (lat + along, lon + street * 1.5))
+    dist_matrix, constraints, addresses = make_instance(points, num_vehicles, timeout)
+
+    stops = rnd.sample(range(1, no_nodes), no_nodes - 1)
+    chains = [stops.pop() for _ in range(3 * fixed_arcs)]
+    constraints['fixed_arcs'] = [chains[i:i + 3] for i in range(0, len(chains), 3)]
+    constraints['same_route'] = [[stops.pop(), stops.pop()] for _ in range(same_route)]
+    constraints['assign_to_route'] = [[] for _ in range(num_vehicles)]
+    for _ in range(assign_to_route):
+        constraints['assign_to_route'][rnd.randrange(num_vehicles)].append(stops.pop())
+    if time_windows:
+        # the solver reads the depot window with an int key, the others with str keys
+        constraints['time_windows'] = {0: [0, 0]}
+        for stop in rnd.sample(stops, int(time_windows * len(stops))):
+            start = rnd.randrange(0, 4 * 3600, 900)
+            constraints['time_windows'][str(stop)] = [start, start + 4 * 3600]
+    return dist_matrix, constraints, addresses
+
+
+def recorded_instance(payload_file):
+    """Replays a /vrp payload recorded with PAYLOAD_RECORD_DIR. Durations are estimated from the coordinates unless
+    the payload carries a dist_matrix."""
+    with open(payload_file) as payload_handle:
+        payload = json.load(payload_handle)
+    addresses = payload['data']
+    constraints = payload['constraints']
+    for tag in ['dwell_duration', 'time_windows']:
+        if isinstance(constraints[tag], list):
+            transform_to_index_value_format(constraints, tag)
+    dist_matrix = payload.get('dist_matrix') or \
+        {'durations': [[walking_duration(as_point(p), as_point(q)) for q in addresses] for p in addresses]}
+    return dist_matrix, constraints, addresses
+
+
+def as_point(address):
+    return float(address['lat']), float(address['lon'])
+
+
+def make_instance(points, num_vehicles, timeout):
+    durations = [[walking_duration(p, q) for q in points] for p in points]
+    addresses = [{'lat': lat, 'lon': lon, 'street': 'Street', 'number': str(idx), 'code': '71739',
+                  'city': 'Oberriexingen', 'name': 'Stop ' + str(idx), 'hint': ''}
+                 for idx, (lat, lon) in enumerate(points)]
+    return {'durations': durations}, empty_constraints(num_vehicles, timeout), addresses
+
+
+def empty_constraints(num_vehicles, timeout):
+    return {
+        'num_visits_to_max_tour_len_ration': [2, 1],
+        'timeout': timeout,
+        'depot': 0,
+        'num_vehicles': num_vehicles,
+        'fixed_arcs': [],
+        'assign_to_route': [],
+        'same_route': [],
+        'same_route_ordered': [],
+        'different_route': [],
+        'dwell_duration': {-1: 300},
+        'time_windows': {},
+        'planningType': 'foot'
+    }
+
+
+def walking_duration(p, q):
+    """Seconds to walk the equirectangular distance between two lat/lon points."""
+    lat = math.radians((p[0] + q[0]) / 2)
+    dx = math.radians(q[1] - p[1]) * math.cos(lat)
+    dy = math.radians(q[0] - p[0])
+    return int(6371000 * math.hypot(dx, dy) / WALKING_SPEED)
@@ -0,0 +1,55 @@
+"""Fetches a matrix tiled from the fake matrix server through both endpoint flavours and checks the assembly.
+
+Usage: python -m main.benchmark.matrix_fetch [no_nodes]
+"""
+import sys
+import time
+
+import numpy as np
+
+from main.benchmark.fake_matrix_server import start_server, MatrixHandler, ORS_PATH, OSRM_PATH
+from main.benchmark.instances import random_instance
+from main.matrix_fetcher import TiledMatrixFetcher, OrsEndpoint, OsrmEndpoint
+
+
+def run(no_nodes):
+    dist_matrix, _, addresses = random_instance(no_nodes)
+    expected = np.array(dist_matrix['durations'], dtype=np.float64)
+    server = start_server()
+    base_url = 'http://127.0.0.1:' + str(server.server_port)
+    MatrixHandler.fail_every = 7
+    MatrixHandler.latency = 0.05
+
+    endpoints = [('ors', OrsEndpoint(base_url + ORS_PATH + 'foot-walking', 'key')),
+                 ('osrm', OsrmEndpoint(base_url + OSRM_PATH + '{}'))]
+    for name, endpoint in endpoints:
+        for max_workers in [1, 4]:
+            MatrixHandler.requests_served = 0
+            fetcher = TiledMatrixFetcher(endpoint, max_workers=max_workers, backoff=0.01)
+            start = time.time()
+            matrix = fetcher.fetch(addresses)
+            elapsed = time.time() - start
+            if not np.array_equal(matrix, expected):
+                raise AssertionError('Tiled matrix differs for ' + name)
+            print('{:>5} workers={} requests={:>4} {:>8.2f}s'.format(name, max_workers, MatrixHandler.requests_served,
+                                                                   elapsed))
+
+        rows = [3, 1, 4]
+        block = TiledMatrixFetcher(endpoint, backoff=0.01).fetch(addresses, rows, None)
+        if not np.array_equal(block, expected[rows, :]):
+            raise AssertionError('Partial matrix differs for ' + name)
+
+    # rate limited: every 7th request is answered with 429 and Retry-After: 1
+    MatrixHandler.retry_after = 1
+    MatrixHandler.requests_served = 0
+    start = time.time()
+    matrix = TiledMatrixFetcher(endpoints[0][1], backoff=0.01).fetch(addresses)
+    elapsed = time.time() - start
+    if not np.array_equal(matrix, expected):
+        raise AssertionError('Tiled matrix differs after Retry-After')
+    print('retry-after requests={:>4} {:>8.2f}s'.format(MatrixHandler.requests_served, elapsed))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 300)
@@ -0,0 +1,96 @@
+"""Instances which once got routes breaking their constraints, solved again and checked.
+
+Usage: python -m main.benchmark.regressions [names...]
+"""
+import random
+import sys
+
+from main.benchmark.instances import make_instance, street_grid_instance, DEPOT, BLOCK
+from main.decompose import use_decomposition, solve_decomposed
+from main.run_algorithm import solve
+
+
+def fixed_arc_next_to_co_located_stop():
+    """
+    The fixed arc 2 -> 5 cannot be contracted, as the window of 5 opens long after the one of 2 closes. Stop 3 is in
+    the building of 2 and must not be merged into a super node with it, which would put 3 between 2 and 5.
+    """
+    lat, lon = DEPOT
+    points = [DEPOT, (lat + BLOCK, lon), (lat + 2 * BLOCK, lon), (lat + 2 * BLOCK, lon), (lat, lon + 3 * BLOCK),
+              (lat + 4 * BLOCK, lon), (lat + BLOCK, lon + BLOCK), (lat, lon + 2 * BLOCK)]
+    dist_matrix, constraints, addresses = make_instance(points, num_vehicles=1, timeout=2)
+    constraints['fixed_arcs'] = [[2, 5]]
+    constraints['assign_to_route'] = [[]]
+    constraints['time_windows'] = {0: [0, 0], '2': [0, 2000], '5': [5000, 9000]}
+    return dist_matrix, constraints, addresses
+
+
+def different_route_partners_in_one_cluster():
+    """
+    So many different_route pairs that the partition of the decomposition puts partners into the cluster of one
+    vehicle, which cannot meet them, although the whole instance can.
+    """
+    dist_matrix, constraints, addresses = street_grid_instance(60, num_vehicles=3, timeout=3)
+    rnd = random.Random(0)
+    constraints['different_route'] = [sorted(rnd.sample(range(1, 60), 2)) for _ in range(40)]
+    constraints['decompose'] = True
+    return dist_matrix, constraints, addresses
+
+
+CASES = [
+    ('fixed-arc-next-to-co-located-stop', fixed_arc_next_to_co_located_stop),
+    ('different-route-partners-in-one-cluster', different_route_partners_in_one_cluster),
+]
+
+
+def solve_case(dist_matrix, constraints, addresses):
+    """Solves like run_algorithm.mainrunner, returning routes of node indices."""
+    if use_decomposition(constraints, len(addresses)):
+        return solve_decomposed(dist_matrix, constraints, addresses, solve)
+    return solve(dist_matrix, constraints)
+
+
+def violations(routes, constraints):
+    """The constraints of the json constraints the routes of nodes, with the depot at both ends, break."""
+    depot = constraints['depot']
+    vehicle_of = dict((node, vehicle) for vehicle, route in enumerate(routes) for node in route if node != depot)
+    position = dict((node, idx) for route in routes for idx, node in enumerate(route) if node != depot)
+    found = []
+    for chain in constraints['fixed_arcs']:
+        if len(set(vehicle_of.get(node) for node in chain)) > 1 or \
+                [position.get(node) for node in chain] != list(range(position.get(chain[0], 0),
+                                                                     position.get(chain[0], 0) + len(chain))):
+            found.append(('fixed_arcs', chain))
+    for group in constraints['same_route']:
+        if len(set(vehicle_of.get(node) for node in group)) > 1:
+            found.append(('same_route', group))
+    for group in constraints['same_route_ordered']:
+        positions = [position.get(node) for node in group]
+        if len(set(vehicle_of.get(node) for node in group)) > 1 or positions != sorted(positions):
+            found.append(('same_route_ordered', group))
+    for node1, node2 in constraints['different_route']:
+        if vehicle_of.get(node1) == vehicle_of.get(node2):
+            found.append(('different_route', [node1, node2]))
+    for vehicle, route_assignment in enumerate(constraints['assign_to_route']):
+        found += [('assign_to_route', [node]) for node in route_assignment if vehicle_of.get(node) != vehicle]
+    return found
+
+
+def run(names):
+    failed = []
+    for name, case in CASES:
+        if names and name not in names:
+            continue
+        dist_matrix, constraints, addresses = case()
+        for contract in [True, False]:
+            routes = solve_case(dist_matrix, dict(constraints, contract=contract), addresses)
+            broken = violations(routes, constraints) if routes else [('no solution', [])]
+            print('{} contract={}: {} {}'.format(name, contract, routes, broken or 'ok'))
+            if broken:
+                failed.append(name)
+    if failed:
+        raise AssertionError('Constraints broken in ' + ', '.join(sorted(set(failed))))
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
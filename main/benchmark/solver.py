@@ -0,0 +1,154 @@
+"""Benchmark harness around create_data_model and solve.
+
+Every instance is solved in a fresh process, which reports wall time, objective, time to first solution and peak
+resident memory. Results are written as json lines, so runs can be compared.
+
+Usage: python -m main.benchmark.solver run [--timeout s] [--output file] [--recorded payload.json ...] [--only name]
+       python -m main.benchmark.solver compare baseline.jsonl candidate.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from main.benchmark.instances import street_grid_instance, recorded_instance
+from main.run_algorithm import create_data_model, solve
+
+SUITE = [
+    ('grid-50-v2', dict(no_nodes=50, num_vehicles=2)),
+    ('grid-150-v3', dict(no_nodes=150, num_vehicles=3)),
+    ('grid-150-v3-tw', dict(no_nodes=150, num_vehicles=3, time_windows=0.2)),
+    ('grid-150-v3-mixed', dict(no_nodes=150, num_vehicles=3, same_route=5, assign_to_route=6, fixed_arcs=3)),
+    ('grid-300-v5', dict(no_nodes=300, num_vehicles=5, clusters=5)),
+    ('grid-300-v5-mixed', dict(no_nodes=300, num_vehicles=5, clusters=5, time_windows=0.1, same_route=10,
+                               assign_to_route=10, fixed_arcs=5)),
+    ('grid-600-v8', dict(no_nodes=600, num_vehicles=8, clusters=6)),
+]
+
+
+class NullProgress(object):
+    """Lets solve attach its solution reporter, which measures the time to the first solution."""
+
+    def publish(self, progress):
+        pass
+
+    def stop_requested(self):
+        return False
+
+
+def instances(args):
+    """Yields name and a picklable (kind, source, timeout) spec per selected instance."""
+    for name, parameters in SUITE:
+        if not args.only or name in args.only:
+            yield name, ('grid', parameters, args.timeout)
+    for payload_file in args.recorded:
+        name = 'recorded-' + os.path.splitext(os.path.basename(payload_file))[0]
+        if not args.only or name in args.only:
+            yield name, ('recorded', payload_file, args.timeout)
+
+
+def load_instance(spec):
+    kind, source, timeout = spec
+    if kind == 'grid':
+        return street_grid_instance(timeout=timeout, **source)
+    dist_matrix, constraints, addresses = recorded_instance(source)
+    constraints['timeout'] = timeout
+    return dist_matrix, constraints, addresses
+
+
+def measure(name, spec):
+    """Runs in the child process, solver output is discarded."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    dist_matrix, constraints, addresses = load_instance(spec)
+    start = time.time()
+    create_data_model(dist_matrix, constraints)
+    model_seconds = time.time() - start
+
+    statistics = {}
+    start = time.time()
+    routes = solve(dist_matrix, constraints, statistics, NullProgress())
+    return {
+        'instance': name,
+        'nodes': len(addresses),
+        'vehicles': constraints['num_vehicles'],
+        'timeout': constraints['timeout'],
+        'data_model_seconds': round(model_seconds, 4),
+        'wall_seconds': round(time.time() - start, 3),
+        'first_solution_seconds': statistics.get('first_solution_seconds'),
+        'objective': statistics.get('objective'),
+        'solved': bool(routes),
+        'branches': statistics.get('search', {}).get('branches'),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(args):
+    revision = git_revision()
+    context = multiprocessing.get_context('spawn')
+    with open(args.output, 'a') as outfile:
+        for name, spec in instances(args):
+            pool = context.Pool(1)
+            try:
+                result = pool.apply(measure, (name, spec))
+            finally:
+                pool.close()
+                pool.join()
+            result['revision'] = revision
+            print(json.dumps(result))
+            outfile.write(json.dumps(result) + '\n')
+            outfile.flush()
+
+
+def compare(baseline_file, candidate_file):
+    baseline, candidate = load_results(baseline_file), load_results(candidate_file)
+    print('{:<22} {:>12} {:>12} {:>8} {:>10} {:>10} {:>10}'.format(
+        'instance', 'objective', 'candidate', 'delta', 'first [s]', 'candidate', 'rss delta'))
+    for name in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[name], candidate[name]
+        delta = '-' if not old['objective'] or not new['objective'] else \
+            '{:+.2%}'.format(new['objective'] / old['objective'] - 1)
+        print('{:<22} {:>12} {:>12} {:>8} {:>10} {:>10} {:>+10}'.format(
+            name, str(old['objective']), str(new['objective']), delta, str(old['first_solution_seconds']),
+            str(new['first_solution_seconds']), new['peak_rss_kb'] - old['peak_rss_kb']))
+
+
+def load_results(results_file):
+    """The last result per instance."""
+    with open(results_file) as results_handle:
+        return dict((result['instance'], result) for result in map(json.loads, results_handle))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Solver benchmark')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--timeout', type=int, default=10)
+    run_parser.add_argument('--output', default='bench_results.jsonl')
+    run_parser.add_argument('--recorded', nargs='*', default=[])
+    run_parser.add_argument('--only', nargs='*', default=[])
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args(sys.argv[1:])
+    if arguments.command == 'compare':
+        compare(arguments.baseline, arguments.candidate)
+    else:
+        run(arguments)
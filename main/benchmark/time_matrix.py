@@ -0,0 +1,85 @@
+"""Compares the array based time matrix construction against the former nested loops.
+
+Usage: python -m main.benchmark.time_matrix [sizes...]
+"""
+import copy
+import random
+import sys
+import timeit
+
+import numpy as np
+
+from main.run_algorithm import create_data_model, MAX_TIME_DURATION
+
+DEFAULT_SIZES = [100, 500, 2000]
+
+
+def loop_create_data_model(dist_matrix, json_constraints):
+    """The list based implementation create_data_model had before, kept as reference."""
+    time = loop_time_matrix(dist_matrix, json_constraints['fixed_arcs'])
+    depot_idx = json_constraints['depot']
+    default_dwell_duration = json_constraints['dwell_duration'][-1]
+    for i in range(0, len(time)):
+        for j in range(0, len(time[i])):
+            time[i][j] += default_dwell_duration if i != depot_idx and j != depot_idx else 0
+
+    dwell_duration = json_constraints['dwell_duration']
+    for idx, duration in dwell_duration.items():
+        for idx2, item in enumerate(time[idx]):
+            time[idx][idx2] += (duration - default_dwell_duration) if idx != -1 else 0
+    result = {'time_matrix': time}
+    result.update(json_constraints)
+    return result
+
+
+def loop_time_matrix(dist_matrix, fixed_arcs):
+    durations = dist_matrix['durations']
+
+    for fixed_arc in fixed_arcs:
+        for i in range(0, len(fixed_arc) - 1):
+            durations_to_nodes_for_i = durations[fixed_arc[i]]
+            for to_node_idx in range(0, len(durations_to_nodes_for_i)):
+                if to_node_idx != fixed_arc[i + 1]:
+                    durations_to_nodes_for_i[to_node_idx] = MAX_TIME_DURATION
+            durations[fixed_arc[i]] = durations_to_nodes_for_i
+
+    return durations
+
+
+def make_instance(no_nodes, seed=0):
+    rnd = random.Random(seed)
+    durations = [[0 if i == j else rnd.randint(30, 1800) for j in range(no_nodes)] for i in range(no_nodes)]
+    nodes = rnd.sample(range(1, no_nodes), min(no_nodes - 1, no_nodes // 10 * 2))
+    fixed_arcs = [nodes[i:i + 3] for i in range(0, len(nodes) // 2, 3)]
+    dwell_duration = dict((idx, rnd.randint(60, 900)) for idx in nodes[len(nodes) // 2:])
+    dwell_duration[-1] = 500
+    constraints = {'depot': 0, 'fixed_arcs': fixed_arcs, 'dwell_duration': dwell_duration}
+    return {'durations': durations}, constraints
+
+
+def best_of(func, dist_matrix, constraints, repeat):
+    """Best wall time of func, each run on a fresh copy of the matrix since the loops mutate their input."""
+    copies = []
+    timer = timeit.Timer(lambda: func(copies.pop(), constraints),
+                         setup=lambda: copies.append(copy.deepcopy(dist_matrix)))
+    return min(timer.repeat(number=1, repeat=repeat))
+
+
+def run(sizes, repeat=3):
+    print('{:>6} {:>12} {:>12} {:>8}'.format('nodes', 'loops [ms]', 'numpy [ms]', 'speedup'))
+    for no_nodes in sizes:
+        dist_matrix, constraints = make_instance(no_nodes)
+
+        expected = loop_create_data_model(copy.deepcopy(dist_matrix), constraints)['time_matrix']
+        actual = create_data_model(dist_matrix, constraints)['time_matrix']
+        if not np.array_equal(np.array(expected, dtype=np.int64), actual):
+            raise AssertionError('Results differ for ' + str(no_nodes) + ' nodes')
+
+        loop_time = best_of(loop_create_data_model, dist_matrix, constraints, repeat)
+        numpy_time = best_of(create_data_model, dist_matrix, constraints, repeat)
+        print('{:>6} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(no_nodes, loop_time * 1000, numpy_time * 1000,
+                                                         loop_time / numpy_time))
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,39 @@
+"""Compares search throughput of the native transit evaluators against the Python callbacks at equal timeout.
+
+Usage: python -m main.benchmark.transit [no_nodes] [timeout]
+"""
+import sys
+
+from main.benchmark.instances import random_instance
+from main.presolve import presolve
+from main.run_algorithm import create_data_model, build_model, set_search_parameters, search_statistics, \
+    TRANSIT_NATIVE, TRANSIT_PYTHON
+
+
+def run_mode(dist_matrix, constraints, transit_mode):
+    data = create_data_model(dist_matrix, dict(constraints, transit=transit_mode))
+    data.update(presolve(data))
+    manager, routing, time_dimension = build_model(data)
+    search_parameters = set_search_parameters(data['timeout'])
+    search_parameters.log_search = False
+    solution = routing.SolveWithParameters(search_parameters)
+    statistics = search_statistics(routing)
+    statistics['objective'] = solution.ObjectiveValue() if solution else None
+    return statistics
+
+
+def run(no_nodes, timeout):
+    dist_matrix, constraints, _ = random_instance(no_nodes, timeout=timeout)
+    results = dict((mode, run_mode(dist_matrix, constraints, mode)) for mode in [TRANSIT_PYTHON, TRANSIT_NATIVE])
+
+    print('{:>8} {:>10} {:>12} {:>10} {:>12}'.format('transit', 'branches', 'branches/s', 'solutions', 'objective'))
+    for mode, statistics in results.items():
+        print('{:>8} {:>10} {:>12} {:>10} {:>12}'.format(mode, statistics['branches'], statistics['branches_per_second'],
+                                                        statistics['solutions'], str(statistics['objective'])))
+    python_rate = results[TRANSIT_PYTHON]['branches_per_second']
+    if python_rate:
+        print('gain: {:.2f}x iterations per second'.format(results[TRANSIT_NATIVE]['branches_per_second'] / python_rate))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
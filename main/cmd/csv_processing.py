@@ -1,11 +1,15 @@
 # Function to convert a csv file to a list of dictionaries.  Takes in one variable called &quot;variables_file&quot;
+import csv
 import sys
 from functools import reduce
 
 import requests
 import json
 
-from main.constants import COORDINATES_QUERY, DIST_MATRIX_FILE, ADDRESS_CSV
+from main.constants import COORDINATES_QUERY, DIST_MATRIX_BINARY_FILE, ADDRESS_CSV, NOMINATIM_HEADERS, \
+    GEOCODE_CACHE_FILE
+from main.geocoding import Geocoder, JsonFileGeocodeCache
+from main.matrix_file import is_binary, save_matrix
 from main.requests_util import request_dist_matrix, make_url
 from main.util import restrict_to_keys, json_file_name_from_csv, resolve_address_file
 
@@ -21,32 +25,75 @@ def csv_dict_list(csv_file):
             for row_with_header in rows_with_header]
 
 
-def fetch_coordinates(location):
+def fetch_coordinates(location, session=requests):
     url = COORDINATES_QUERY.format(
         'de', location['code'], location['number'], location['street'])
-    response = requests.get(url)
+    response = session.get(url, headers=NOMINATIM_HEADERS, timeout=10)
     keys = ['lat', 'lon']
-    if response.status_code == 200:
-        first_hit = response.json()[0]
-        return restrict_to_keys(first_hit, keys)
+    if response.status_code != 200:
+        raise ConnectionError(response.status_code)
+    hits = response.json()
+    if hits:
+        return restrict_to_keys(hits[0], keys)
+    return None
 
 
-def to_json_with_coordinates(file_name):
+def address_key(location):
+    return '|'.join(str(location.get(key, '')).strip().lower() for key in ['code', 'street', 'number'])
+
+
+def make_geocoder(cache_file=GEOCODE_CACHE_FILE):
+    """Nominatim allows one request per second, so concurrency only hides the latency of the lookups."""
+    return Geocoder(fetch_coordinates, address_key, JsonFileGeocodeCache(cache_file), max_workers=2, rate=1.0)
+
+
+def to_json_with_coordinates(file_name, geocoder=None):
+    """
+    Geocodes the addresses of the csv file and writes them with their coordinates to the json file of the same name.
+    The constraints refer to addresses by their position in the csv, so if any address cannot be geocoded, no json is
+    written, the rows are reported and a ValueError is raised; correct them, or remove them and their constraints.
+    """
     addresses_dict = csv_dict_list(file_name)
-    coor_out = []
-    for address in addresses_dict:
-        coordinates = fetch_coordinates(address)
-        coord_str = "[" + coordinates['lon'] + ',' + coordinates['lat'] + "]"
-        coor_out.append(coord_str)
-        address.update(coordinates)
+    geocoder = geocoder or make_geocoder()
+    coordinates_list, errors = geocoder.geocode_all(addresses_dict)
+
+    resolved, unresolved = [], []
+    for row, (address, coordinates) in enumerate(zip(addresses_dict, coordinates_list), start=2):
+        if coordinates:
+            address.update(coordinates)
+            resolved.append(address)
+        else:
+            unresolved.append(dict(address, row=row, error=errors.get(address_key(address), 'not found')))
+
+    if unresolved:
+        report_file = unresolved_report_file_name(file_name)
+        dump_unresolved_report(unresolved, report_file)
+        raise ValueError('Could not geocode ' + str(len(unresolved)) + ' addresses, see ' + report_file +
+                         '; the node indices of the constraints would shift without them')
 
     with open(json_file_name_from_csv(file_name), 'w') as outfile:
-        json.dump(addresses_dict, outfile)
+        json.dump(resolved, outfile)
+    return resolved
+
+
+def unresolved_report_file_name(file_name):
+    return file_name.replace('.csv', '_unresolved.csv')
+
 
-    return addresses_dict
+def dump_unresolved_report(unresolved, report_file):
+    """Writes the rows which could not be geocoded, with their line in the csv and the reason."""
+    keys = ['row'] + [key for key in unresolved[0].keys() if key not in ['row', 'error']] + ['error']
+    with open(report_file, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=keys, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(unresolved)
 
 
-def dump_to_dist_matrix_file(json_dict, dist_matrix_file):
+def dump_to_dist_matrix_file(json_dict, dist_matrix_file, addresses=None, planning_type=None):
+    """Writes the durations to a binary matrix file of the addresses if dist_matrix_file ends with .npy, else as json."""
+    if is_binary(dist_matrix_file):
+        save_matrix(dist_matrix_file, json_dict['durations'], addresses, planning_type)
+        return
     keys = ['durations']
     dist_matrix_dict = dict(zip(keys, [json_dict[k] for k in keys]))
     with open(json_file_name_from_csv(dist_matrix_file), 'w') as outfile:
@@ -62,7 +109,7 @@ def route_to_adress(route, addresses):
 
 
 def dist_matrix_file():
-    dist_matrix_file_res = DIST_MATRIX_FILE
+    dist_matrix_file_res = DIST_MATRIX_BINARY_FILE
     if len(sys.argv) > 2:
         dist_matrix_file_res = str(sys.argv[2])
     return dist_matrix_file_res
@@ -75,4 +122,4 @@ if __name__ == '__main__':
     response_json = request_dist_matrix(adresses_json,'5b3ce3597851110001cf624854f2480e0f4a47ec9cf4c2d6ac7126f0cd ', 'foot')
 
     if response_json:
-        dump_to_dist_matrix_file(response_json, dist_matrix_file())
+        dump_to_dist_matrix_file(response_json, dist_matrix_file(), adresses_json, 'foot')
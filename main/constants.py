@@ -2,7 +2,16 @@ ADDRESS_CSV = './data/address.csv'
 
 COORDINATES_QUERY = "https://nominatim.openstreetmap.org/search?format=json&country={}&postalcode={}&street={}+{}"
 
+NOMINATIM_HEADERS = {'User-Agent': 'vrp-sternsinger'}  # required by the nominatim usage policy
+
 DIST_MATRIX_FILE = './data/dist_matrix.json'
+DIST_MATRIX_BINARY_FILE = './data/dist_matrix.npy'
+
+GEOCODE_CACHE_FILE = './data/geocode_cache.json'
+
+GEOCODE_CACHE_TTL = 90 * 24 * 60 * 60
+
+MAX_TIME_DURATION = 60 * 60 * 360 * 1000  # duration of blocked arcs
 
 OPENSTREETMAP_LINK_URL = 'https://routing.openstreetmap.de'
 
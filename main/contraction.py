@@ -0,0 +1,165 @@
+"""Presolve contracting fixed arc chains and co-located stops into super nodes."""
+import numpy as np
+
+from main.constants import MAX_TIME_DURATION
+from main.matrix_file import durations_array
+
+CO_LOCATED_MAX_DURATION = 5  # seconds in both directions between stops of one building
+
+
+class Contraction(object):
+    """
+    Super nodes of an instance: groups[super_node] lists the original nodes in visiting order. Travelling from a
+    super node starts at its last node and arriving at one ends at its first node; the durations between its nodes
+    and their dwell durations make up its dwell duration, its visits count its nodes.
+    """
+
+    def __init__(self, dist_matrix, json_constraints, groups, chains):
+        self.groups = groups
+        self.chains = chains
+        self.super_node = dict((node, idx) for idx, group in enumerate(groups) for node in group)
+        durations = durations_array(dist_matrix)
+        firsts = [group[0] for group in groups]
+        lasts = [group[-1] for group in groups]
+        self.dist_matrix = {'durations': durations[np.ix_(lasts, firsts)]}
+        self.constraints = self._constraints(durations, json_constraints)
+
+    def expand(self, routes):
+        """Routes of super nodes to routes of the original nodes."""
+        return [[node for super_node in route for node in self.groups[super_node]] for route in routes]
+
+    def _constraints(self, durations, json_constraints):
+        dwell = dwell_durations(json_constraints['dwell_duration'])
+        constraints = dict(json_constraints)
+        constraints.update({
+            'depot': self.super_node[json_constraints['depot']],
+            'fixed_arcs': [self.remap_sequence(chain) for chain in json_constraints['fixed_arcs']
+                           if chain not in self.chains],
+            'same_route': [group for group in (self.remap_set(group) for group in json_constraints['same_route'])
+                           if len(group) > 1],
+            'same_route_ordered': [group for group in (self.remap_sequence(group)
+                                                       for group in json_constraints['same_route_ordered'])
+                                   if len(group) > 1],
+            'different_route': [self.remap_sequence(pair) for pair in json_constraints['different_route']],
+            'assign_to_route': [self.remap_set(route_assignment)
+                                for route_assignment in json_constraints['assign_to_route']],
+            'time_windows': self._time_windows(durations, json_constraints['time_windows'], dwell),
+            'dwell_duration': self._dwell_durations(durations, dwell),
+            'visits': [len(group) for group in self.groups],
+        })
+        if json_constraints.get('initial_routes'):
+            constraints['initial_routes'] = [self.remap_set(route) for route in json_constraints['initial_routes']]
+        return constraints
+
+    def remap_set(self, nodes):
+        return list(dict.fromkeys(self.super_node[node] for node in nodes))
+
+    def remap_sequence(self, nodes):
+        """Super nodes of the nodes with repetitions of consecutive nodes of one super node removed."""
+        super_nodes = [self.super_node[node] for node in nodes]
+        return [super_node for idx, super_node in enumerate(super_nodes)
+                if idx == 0 or super_nodes[idx - 1] != super_node]
+
+    def _dwell_durations(self, durations, dwell):
+        result = {-1: dwell[-1]}
+        for idx, group in enumerate(self.groups):
+            if len(group) > 1:
+                result[idx] = int(group_offsets(durations, group, dwell)[-1] + dwell.get(group[-1], dwell[-1]))
+            elif group[0] in dwell:
+                result[idx] = dwell[group[0]]
+        return result
+
+    def _time_windows(self, durations, time_windows, dwell):
+        result = {}
+        for key, window in time_windows.items():
+            if isinstance(key, int) and key == 0:
+                # read by the solver for the vehicle starts
+                result[key] = window
+        for idx, group in enumerate(self.groups):
+            window = group_time_window(durations, group, dwell, time_windows)
+            if window:
+                result[str(idx)] = window
+        return result
+
+
+def contract(dist_matrix, json_constraints, max_co_located_duration=CO_LOCATED_MAX_DURATION):
+    """
+    Returns the Contraction of the fixed arc chains and groups of co-located stops, None if nothing can be contracted.
+    Stops are only merged if the constraints of the super node can express theirs: they must not be assigned to
+    different routes or be different_route partners, stops of fixed arcs which are not contracted as a chain and of
+    same_route and same_route_ordered groups are left alone and the shifted time windows of the stops have to
+    intersect, as a super node is visited without waiting.
+    """
+    durations = durations_array(dist_matrix)
+    no_nodes = len(durations)
+    depot = json_constraints['depot']
+    dwell = dwell_durations(json_constraints['dwell_duration'])
+    time_windows = json_constraints['time_windows']
+    vehicle_of = dict((node, vehicle) for vehicle, route_assignment in enumerate(json_constraints['assign_to_route'])
+                      for node in route_assignment)
+    partners = set(tuple(pair) for pair in json_constraints['different_route'])
+
+    def compatible(group):
+        vehicles = set(vehicle_of[node] for node in group if node in vehicle_of)
+        members = set(group)
+        return depot not in members and len(vehicles) <= 1 and \
+            not any(node1 in members and node2 in members for node1, node2 in partners) and \
+            group_offsets(durations, group, dwell)[-1] < MAX_TIME_DURATION and \
+            group_time_window(durations, group, dwell, time_windows) != []
+
+    chains, grouped = [], set()
+    for chain in json_constraints['fixed_arcs']:
+        # chains sharing nodes with an earlier one stay fixed arcs
+        if len(set(chain)) == len(chain) and not grouped.intersection(chain) and compatible(chain):
+            chains.append(chain)
+            grouped.update(chain)
+    # stops of fixed arcs which were not contracted and of same_route groups keep their own node, a super node
+    # of them could break the arc or the order of the solver's constraints
+    excluded = set(node for group in json_constraints['fixed_arcs'] + json_constraints['same_route'] +
+                   json_constraints['same_route_ordered'] for node in group)
+
+    groups = list(chains)
+    close = (durations <= max_co_located_duration) & (durations.T <= max_co_located_duration)
+    for node in range(no_nodes):
+        if node == depot or node in grouped:
+            continue
+        group = [node]
+        grouped.add(node)
+        if node in excluded:
+            groups.append(group)
+            continue
+        for other in np.flatnonzero(close[node]):
+            other = int(other)
+            if other not in grouped and other not in excluded and compatible(group + [other]):
+                group.append(other)
+                grouped.add(other)
+        groups.append(group)
+    groups.append([depot])
+
+    if len(groups) == no_nodes:
+        return None
+    groups.sort(key=lambda group: min(group))
+    return Contraction(dist_matrix, json_constraints, groups, chains)
+
+
+def dwell_durations(dwell_duration):
+    return dict((int(idx), int(duration)) for idx, duration in dwell_duration.items())
+
+
+def group_offsets(durations, group, dwell):
+    """Time from arriving at the first node of the group to arriving at each of its nodes."""
+    steps = [durations[node, successor] + dwell.get(node, dwell[-1]) for node, successor in zip(group, group[1:])]
+    return np.concatenate([[0.0], np.cumsum(steps)])
+
+
+def group_time_window(durations, group, dwell, time_windows):
+    """Arrival window at the first node of the group meeting the time windows of all its nodes, None if there are
+    none, [] if they cannot all be met."""
+    windows = [(time_windows.get(str(node)), offset) for node, offset in
+               zip(group, group_offsets(durations, group, dwell))]
+    windows = [(window, offset) for window, offset in windows if window]
+    if not windows:
+        return None
+    start = max(window[0] - offset for window, offset in windows)
+    end = min(window[1] - offset for window, offset in windows)
+    return [int(np.ceil(start)), int(end)] if start <= end else []
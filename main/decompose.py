@@ -0,0 +1,254 @@
+"""Cluster-first, route-second solving for instances too large for one routing model."""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from main.presolve import InfeasibleConstraints
+
+DECOMPOSE_MIN_NODES = int(os.getenv('DECOMPOSE_MIN_NODES', 600))
+BALANCE_SLACK = 1.15  # a cluster may hold this much more than an equal share of the stops
+KMEANS_ITERATIONS = 10
+CLUSTER_TIME_SHARE = 0.7  # of the timeout, the rest is spent on the boundary improvement
+# path building first solutions often miss tight time windows on a single route, insertion finds them
+RETRY_FIRST_SOLUTION_STRATEGY = 'PARALLEL_CHEAPEST_INSERTION'
+
+
+def use_decomposition(json_constraints, no_nodes):
+    decompose = json_constraints.get('decompose')
+    if decompose is None:
+        return no_nodes >= DECOMPOSE_MIN_NODES and json_constraints['num_vehicles'] > 1
+    return bool(decompose)
+
+
+def solve_decomposed(dist_matrix, json_constraints, json_addresses, solve, statistics=None, progress=None):
+    """
+    Partitions the stops into one cluster per vehicle, solves the clusters in parallel processes and then re-solves
+    pairs of neighbouring routes, started from their current routes, so stops near a border can change sides.
+    solve is run_algorithm.solve; returns routes of node indices like it, or [] if a cluster has no solution. If the
+    constraints of a cluster cannot be met, the whole instance is solved with solve instead, reporting to progress.
+
+    The clusters are solved in other processes without progress reports and without the initial_routes of the
+    constraints, decomposition starts from its own clusters.
+    """
+    statistics = {} if statistics is None else statistics
+    durations = np.asarray(dist_matrix['durations'], dtype=np.float64)
+    num_vehicles = json_constraints['num_vehicles']
+    points = planar_points(json_addresses)
+    clusters = partition(points, json_constraints)
+
+    workers = max(1, min(num_vehicles, os.cpu_count() or 1))
+    rounds = math.ceil(num_vehicles / workers)
+    cluster_timeout = max(1, int(json_constraints['timeout'] * CLUSTER_TIME_SHARE / rounds))
+    instances = [sub_instance(durations, json_constraints, cluster, [vehicle], cluster_timeout)
+                 for vehicle, cluster in enumerate(clusters)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(solve_sub_instance, [solve] * len(instances), instances))
+        infeasible = [idx for idx, result in enumerate(results) if 'infeasible' in result[1]]
+        failed = [idx for idx, result in enumerate(results) if not result[0]] if not infeasible else []
+        for idx, result in zip(failed, executor.map(solve_sub_instance, [solve] * len(failed),
+                                                    [retry_instance(instances[idx]) for idx in failed])):
+            results[idx] = result
+    statistics['decomposition'] = {
+        'cluster_sizes': [len(cluster) for cluster in clusters],
+        'cluster_objectives': [result[1].get('objective') for result in results],
+        'retried_clusters': failed
+    }
+    if infeasible:
+        statistics['decomposition']['infeasible_clusters'] = dict((idx, results[idx][1]['infeasible'])
+                                                                  for idx in infeasible)
+        print("Decomposition: infeasible clusters, solving the whole instance")
+        return solve(dist_matrix, json_constraints, statistics, progress)
+    if not all(result[0] for result in results):
+        return []
+    routes = [route_to_global(result[0][0], instance[2]) for result, instance in zip(results, instances)]
+
+    pairs = neighbouring_pairs(routes, points, json_constraints['depot'])
+    improve_timeout = max(1, int(json_constraints['timeout'] * (1 - CLUSTER_TIME_SHARE) /
+                                 math.ceil(max(1, len(pairs)) / workers)))
+    instances = [sub_instance(durations, json_constraints, routes[a][1:-1] + routes[b][1:-1], [a, b],
+                              improve_timeout, [routes[a][1:-1], routes[b][1:-1]])
+                 for a, b in pairs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        improved = list(executor.map(solve_sub_instance, [solve] * len(instances), instances))
+    for (a, b), instance, (pair_routes, _) in zip(pairs, instances, improved):
+        if pair_routes:
+            routes[a], routes[b] = [route_to_global(route, instance[2]) for route in pair_routes]
+
+    statistics['decomposition'].update(pairs=pairs,
+                                       pair_objectives=[result[1].get('objective') for result in improved])
+    return routes
+
+
+def solve_sub_instance(solve, instance):
+    """The routes of the sub instance and its statistics, with the reasons in 'infeasible' and no routes if its
+    constraints cannot be met."""
+    dist_matrix, constraints, nodes = instance
+    statistics = {}
+    try:
+        return solve(dist_matrix, constraints, statistics), statistics
+    except InfeasibleConstraints as e:
+        statistics['infeasible'] = e.reasons
+        return [], statistics
+
+
+def retry_instance(instance):
+    dist_matrix, constraints, nodes = instance
+    return dist_matrix, dict(constraints, first_solution_strategy=RETRY_FIRST_SOLUTION_STRATEGY), nodes
+
+
+def route_to_global(route, nodes):
+    return [nodes[node] for node in route]
+
+
+def sub_instance(durations, json_constraints, stops, vehicles, timeout, initial_routes=None):
+    """
+    Restricts the instance to the depot, the stops and the vehicles, which become vehicles 0.. of the sub instance.
+    Returns dist_matrix, constraints and the global node of every local node.
+    """
+    depot = json_constraints['depot']
+    nodes = [depot] + [stop for stop in stops if stop != depot]
+    local = dict((node, idx) for idx, node in enumerate(nodes))
+
+    def local_groups(groups):
+        return [[local[node] for node in group if node in local] for group in groups
+                if all(node in local for node in group)]
+
+    route_assignments = json_constraints['assign_to_route']
+    constraints = dict(json_constraints)
+    constraints.update({
+        'depot': 0,
+        'num_vehicles': len(vehicles),
+        'timeout': timeout,
+        'parallel_workers': 1,
+        'decompose': False,
+        'fixed_arcs': local_groups(json_constraints['fixed_arcs']),
+        'same_route': local_groups(json_constraints['same_route']),
+        'same_route_ordered': local_groups(json_constraints['same_route_ordered']),
+        'different_route': local_groups(json_constraints['different_route']),
+        'assign_to_route': [[local[node] for node in route_assignments[vehicle] if node in local]
+                            if vehicle < len(route_assignments) else [] for vehicle in vehicles],
+        'dwell_duration': dict((local.get(int(idx), idx) if int(idx) != -1 else -1, duration)
+                               for idx, duration in json_constraints['dwell_duration'].items()
+                               if int(idx) == -1 or int(idx) in local),
+        'time_windows': dict((type(key)(local[int(key)]), window)
+                             for key, window in json_constraints['time_windows'].items() if int(key) in local),
+    })
+    constraints.pop('initial_routes', None)
+    if initial_routes:
+        constraints['initial_routes'] = [[local[node] for node in route] for route in initial_routes]
+    return {'durations': durations[np.ix_(nodes, nodes)]}, constraints, nodes
+
+
+def planar_points(json_addresses):
+    """Equirectangular projection of the addresses, good enough for distances within a town."""
+    lat_lon = np.array([[float(address['lat']), float(address['lon'])] for address in json_addresses])
+    return np.column_stack([lat_lon[:, 0], lat_lon[:, 1] * np.cos(np.radians(lat_lon[:, 0].mean()))])
+
+
+def partition(points, json_constraints):
+    """
+    Balanced k-means with one cluster per vehicle. Stops bound together by same_route, same_route_ordered or fixed
+    arcs move as one unit, units with an assign_to_route stop stay in the cluster of that vehicle and a unit avoids
+    clusters holding one of its different_route partners, exceeding the balance of the clusters if it has to, as a
+    cluster is served by a single vehicle.
+    """
+    depot = json_constraints['depot']
+    k = json_constraints['num_vehicles']
+    units = constraint_units(len(points), depot, json_constraints)
+    unit_points = np.array([points[unit].mean(axis=0) for unit in units])
+    sizes = np.array([len(unit) for unit in units])
+    capacity = math.ceil(sizes.sum() / k * BALANCE_SLACK)
+
+    forced = {}
+    for vehicle, route_assignment in enumerate(json_constraints['assign_to_route'][:k]):
+        for node in route_assignment:
+            forced.setdefault(node, vehicle)
+    unit_forced = [next((forced[node] for node in unit if node in forced), None) for unit in units]
+    partners = {}
+    for node1, node2 in json_constraints['different_route']:
+        partners.setdefault(node1, set()).add(node2)
+        partners.setdefault(node2, set()).add(node1)
+
+    centers = initial_centers(unit_points, unit_forced, k)
+    free_order = sorted((idx for idx in range(len(units)) if unit_forced[idx] is None), key=lambda idx: -sizes[idx])
+    for _ in range(KMEANS_ITERATIONS):
+        labels = np.full(len(units), -1)
+        loads = np.zeros(k, dtype=int)
+        members = [set() for _ in range(k)]
+        for idx, vehicle in enumerate(unit_forced):
+            if vehicle is not None:
+                labels[idx] = vehicle
+                loads[vehicle] += sizes[idx]
+                members[vehicle].update(units[idx])
+        for idx in free_order:
+            unit_partners = set().union(*[partners.get(node, set()) for node in units[idx]])
+            by_distance = np.argsort(((centers - unit_points[idx]) ** 2).sum(axis=1))
+            fitting = [c for c in by_distance if loads[c] + sizes[idx] <= capacity] or [int(np.argmin(loads))]
+            label = next((c for c in fitting if not members[c] & unit_partners),
+                         next((c for c in by_distance if not members[c] & unit_partners), fitting[0]))
+            labels[idx] = label
+            loads[label] += sizes[idx]
+            members[label].update(units[idx])
+        new_centers = np.array([unit_points[labels == c].mean(axis=0) if (labels == c).any() else centers[c]
+                                for c in range(k)])
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+
+    return [sorted(node for idx in np.flatnonzero(labels == c) for node in units[idx]) for c in range(k)]
+
+
+def initial_centers(unit_points, unit_forced, k):
+    """Centers of the assigned stops for vehicles with assign_to_route, farthest point seeding for the rest."""
+    centers = []
+    for vehicle in range(k):
+        forced_points = [point for point, forced in zip(unit_points, unit_forced) if forced == vehicle]
+        centers.append(np.mean(forced_points, axis=0) if forced_points else None)
+    for vehicle in range(k):
+        if centers[vehicle] is None:
+            known = np.array([center for center in centers if center is not None])
+            if len(known):
+                distance = ((unit_points[:, None, :] - known[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+                centers[vehicle] = unit_points[int(np.argmax(distance))]
+            else:
+                centers[vehicle] = unit_points[int(np.argmax(((unit_points - unit_points.mean(axis=0)) ** 2).sum(1)))]
+    return np.array(centers)
+
+
+def constraint_units(no_nodes, depot, json_constraints):
+    """Groups of stops which have to end up on one route, merged with union-find."""
+    parent = list(range(no_nodes))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for group in json_constraints['same_route'] + json_constraints['same_route_ordered'] + \
+            json_constraints['fixed_arcs']:
+        for node1, node2 in zip(group, group[1:]):
+            parent[find(node1)] = find(node2)
+
+    units = {}
+    for node in range(no_nodes):
+        if node != depot:
+            units.setdefault(find(node), []).append(node)
+    return list(units.values())
+
+
+def neighbouring_pairs(routes, points, depot):
+    """Disjoint pairs of routes, closest route centroids first."""
+    centroids = [points[[node for node in route if node != depot]].mean(axis=0) if len(route) > 2 else None
+                 for route in routes]
+    candidates = sorted((float(((centroids[a] - centroids[b]) ** 2).sum()), a, b)
+                        for a in range(len(routes)) for b in range(a + 1, len(routes))
+                        if centroids[a] is not None and centroids[b] is not None)
+    paired, pairs = set(), []
+    for _, a, b in candidates:
+        if a not in paired and b not in paired:
+            paired.update([a, b])
+            pairs.append((a, b))
+    return pairs
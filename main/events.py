@@ -0,0 +1,64 @@
+"""Job status events published over redis pub/sub and streamed to clients as server-sent events."""
+import json
+import os
+import time
+
+KEEPALIVE_SECONDS = 15
+# a stream holds a thread of the web worker, so streams are short and EventSource clients reconnect by themselves,
+# getting the current status first again
+MAX_STREAM_SECONDS = int(os.getenv('MAX_STREAM_SECONDS', 30))
+RECONNECT_MILLISECONDS = 3000
+TERMINAL_STATUSES = ['completed', 'failed']
+
+
+def events_channel(job_id):
+    return 'vrp:events:' + job_id
+
+
+def publish_event(connection, job_id, event, data):
+    connection.publish(events_channel(job_id), json.dumps({'event': event, 'data': data}))
+
+
+def publish_status(connection, job_id, status):
+    publish_event(connection, job_id, 'status', {'id': job_id, 'status': status})
+
+
+def subscribe(connection, job_id):
+    """Subscribes to the events of the job; subscribe before reading the job's state to miss no transition."""
+    pubsub = connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(events_channel(job_id))
+    return pubsub
+
+
+def event_stream(pubsub, initial_events, keepalive=KEEPALIVE_SECONDS, max_seconds=MAX_STREAM_SECONDS):
+    """
+    Yields the (event, data) pairs of initial_events and then every published event of the subscription as
+    server-sent events, with a comment line every keepalive seconds without one. Ends once the job completed or
+    failed, or after max_seconds, telling the client to reconnect after RECONNECT_MILLISECONDS.
+    """
+    try:
+        yield 'retry: {}\n\n'.format(RECONNECT_MILLISECONDS)
+        for event, data in initial_events:
+            yield format_event(event, data)
+            if is_terminal(event, data):
+                return
+        deadline = time.time() + max_seconds
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=min(keepalive, max(0, deadline - time.time())))
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            payload = json.loads(message['data'])
+            yield format_event(payload['event'], payload['data'])
+            if is_terminal(payload['event'], payload['data']):
+                return
+    finally:
+        pubsub.close()
+
+
+def format_event(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+def is_terminal(event, data):
+    return event == 'status' and data.get('status') in TERMINAL_STATUSES
@@ -0,0 +1,38 @@
+"""Machine readable exports of the routes of a job: GeoJSON and GPX."""
+import json
+from xml.sax.saxutils import escape
+
+from main.template import to_address_line
+
+GPX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx version="1.1" creator="vrp-sternsinger" xmlns="http://www.topografix.com/GPX/1/1">\n')
+
+
+def to_geojson(json_routes):
+    """A FeatureCollection with a LineString per route and a Point per stop, properties tell route and position."""
+    features = []
+    for route_idx, json_route in enumerate(json_routes):
+        coordinates = [[float(address['lon']), float(address['lat'])] for address in json_route]
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'LineString', 'coordinates': coordinates},
+                         'properties': {'route': route_idx, 'stops': len(json_route)}})
+        features += [{'type': 'Feature',
+                      'geometry': {'type': 'Point', 'coordinates': coordinate},
+                      'properties': {'route': route_idx, 'position': position, 'name': address.get('name', ''),
+                                     'address': to_address_line(address)}}
+                     for position, (address, coordinate) in enumerate(zip(json_route, coordinates))]
+    return json.dumps({'type': 'FeatureCollection', 'features': features})
+
+
+def to_gpx(json_routes, route_indices=None):
+    """A GPX document with an rte per route, of the routes with route_indices or all of them."""
+    route_indices = range(len(json_routes)) if route_indices is None else route_indices
+    parts = [GPX_HEADER]
+    for route_idx in route_indices:
+        parts.append('  <rte>\n    <name>Tour {}</name>\n'.format(route_idx + 1))
+        parts += ['    <rtept lat="{}" lon="{}"><name>{}</name><desc>{}</desc></rtept>\n'.format(
+            float(address['lat']), float(address['lon']), escape(str(address.get('name', ''))),
+            escape(to_address_line(address))) for address in json_routes[route_idx]]
+        parts.append('  </rte>\n')
+    parts.append('</gpx>\n')
+    return ''.join(parts)
@@ -0,0 +1,158 @@
+"""Batch geocoding with deduplication, a persistent cache, bounded concurrency and a rate limit."""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from main.constants import GEOCODE_CACHE_FILE, GEOCODE_CACHE_TTL
+from main.matrix_fetcher import pooled_session, chunks
+
+
+class RateLimiter(object):
+    """Spaces calls to acquire at least 1 / rate seconds apart across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class JsonFileGeocodeCache(object):
+    """Address key -> coordinates, kept in a json file."""
+
+    def __init__(self, path=GEOCODE_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as cache_file:
+                self.entries = json.load(cache_file)
+
+    def get_many(self, keys):
+        return dict((key, self.entries[key]) for key in keys if key in self.entries)
+
+    def set_many(self, values):
+        if not values:
+            return
+        self.entries.update(values)
+        with open(self.path, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+
+
+class RedisGeocodeCache(object):
+    """Address key -> coordinates, stored as json in redis with a ttl."""
+
+    def __init__(self, connection, ttl=GEOCODE_CACHE_TTL, prefix='geocode:'):
+        self.connection = connection
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        values = self.connection.mget([self.prefix + key for key in keys])
+        return dict((key, json.loads(value)) for key, value in zip(keys, values) if value is not None)
+
+    def set_many(self, values):
+        pipeline = self.connection.pipeline()
+        for key, coordinates in values.items():
+            pipeline.set(self.prefix + key, json.dumps(coordinates), ex=self.ttl)
+        pipeline.execute()
+
+
+class LruGeocodeCache(object):
+    """Keeps the max_entries most recently used entries in memory in front of another cache."""
+
+    def __init__(self, backing, max_entries=10000):
+        self.backing = backing
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self.lock:
+            found = {}
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+        missing = [key for key in keys if key not in found]
+        from_backing = self.backing.get_many(missing) if missing else {}
+        self._remember(from_backing)
+        found.update(from_backing)
+        return found
+
+    def set_many(self, values):
+        self.backing.set_many(values)
+        self._remember(values)
+
+    def _remember(self, values):
+        with self.lock:
+            for key, coordinates in values.items():
+                self.entries[key] = coordinates
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class Geocoder(object):
+    """
+    Resolves a list of addresses to coordinates in input order. Repeated addresses are looked up once, cached ones
+    not at all, the rest run in batches on max_workers threads through one pooled session, throttled to rate lookups
+    per second. The cache is updated after every batch, so an aborted run keeps what it resolved.
+
+    lookup(session, address) returns a {'lat', 'lon'} dict or None when the address could not be resolved; failures
+    are not cached.
+    """
+
+    def __init__(self, lookup, key, cache=None, max_workers=2, rate=1.0, batch_size=50, session=None):
+        self.lookup = lookup
+        self.key = key
+        self.cache = cache
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.rate_limiter = RateLimiter(rate)
+        self.session = session or pooled_session(max_workers)
+
+    def uncached(self, addresses):
+        """The number of distinct addresses which are not in the cache and would be looked up."""
+        keys = list(dict.fromkeys(self.key(address) for address in addresses))
+        return len(keys) - len(self.cache.get_many(keys) if self.cache else {})
+
+    def geocode_all(self, addresses):
+        """Returns a list with coordinates or None per address and a dict with the error per unresolved key."""
+        keys = [self.key(address) for address in addresses]
+        address_by_key = dict(zip(keys, addresses))
+        resolved = self.cache.get_many(list(address_by_key)) if self.cache else {}
+        missing = [key for key in address_by_key if key not in resolved]
+
+        errors = {}
+
+        def resolve(key):
+            self.rate_limiter.acquire()
+            try:
+                coordinates = self.lookup(self.session, address_by_key[key])
+            except Exception as e:
+                errors[key] = str(e)
+                return None
+            if not coordinates:
+                errors[key] = 'not found'
+            return coordinates
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch in chunks(missing, self.batch_size):
+                fetched = dict((key, coordinates) for key, coordinates in zip(batch, executor.map(resolve, batch))
+                               if coordinates)
+                if self.cache:
+                    self.cache.set_many(fetched)
+                resolved.update(fetched)
+        return [resolved.get(key) for key in keys], errors
@@ -0,0 +1,109 @@
+"""Composes the route mails and delivers them over kept alive SMTP connections or the SendGrid API."""
+import datetime
+import os
+import smtplib
+import time
+from email.message import EmailMessage
+from functools import lru_cache
+
+import sendgrid
+from sendgrid.helpers.mail import Email, Content, Mail
+
+SUBJECT = 'Route Planning'
+# an idle connection is checked with NOOP before reuse and replaced after this many seconds
+SMTP_KEEPALIVE_SECONDS = int(os.getenv('SMTP_KEEPALIVE_SECONDS', 60))
+
+
+def compose(config, mail_to, routes_html):
+    msg = EmailMessage()
+    msg['From'] = config['MAIL_USERNAME']
+    msg['To'] = mail_to
+    msg['Subject'] = SUBJECT
+    message = """Send at {} \n content {}""".format(datetime.datetime.now(), routes_html)
+    msg.set_content(message)
+    return msg
+
+
+def send_messages(config, messages):
+    """Sends the messages, composed by compose, over the kept alive connection and returns a status per message."""
+    if config.get('MAIL_TYPE') == 'gmail':
+        return smtp_pool.send(config, messages)
+    return [send_sendgrid(config, msg) for msg in messages]
+
+
+def send_sendgrid(config, msg):
+    apikey = config['SENDGRID_API_KEY']
+    mail = Mail(Email(msg['From']), msg['Subject'], Email(msg['To']), Content("text/plain", msg.get_content()))
+    print("Sendgrid..." + str(msg['To']) + " " + str(msg['From']))
+    response = sendgrid_client(apikey).client.mail.send.post(request_body=mail.get())
+    return response.status_code
+
+
+@lru_cache(maxsize=4)
+def sendgrid_client(apikey):
+    return sendgrid.SendGridAPIClient(apikey=apikey)
+
+
+class SmtpPool(object):
+    """One kept alive SMTP connection per server and user, shared by the mails sent from this process."""
+
+    def __init__(self, keepalive=SMTP_KEEPALIVE_SECONDS):
+        self.keepalive = keepalive
+        self.connections = {}
+
+    def send(self, config, messages):
+        key = (config['MAIL_SERVER'], config['MAIL_PORT'], config['MAIL_USERNAME'])
+        statuses = []
+        for msg in messages:
+            try:
+                statuses.append(self.connection(key, config).send_message(msg))
+            except smtplib.SMTPServerDisconnected:
+                self.close(key)
+                statuses.append(self.connection(key, config).send_message(msg))
+            self.connections[key] = (self.connections[key][0], time.time())
+        return statuses
+
+    def connection(self, key, config):
+        if key in self.connections:
+            server, last_used = self.connections[key]
+            if time.time() - last_used < self.keepalive and is_alive(server):
+                return server
+            self.close(key)
+        server = make_server(config)
+        if config.get('MAIL_PASSWORD'):
+            server.login(config['MAIL_USERNAME'], config.get('MAIL_PASSWORD'))
+        self.connections[key] = (server, time.time())
+        return server
+
+    def close(self, key):
+        server, _ = self.connections.pop(key)
+        try:
+            server.quit()
+        except smtplib.SMTPException:
+            server.close()
+
+
+def is_alive(server):
+    try:
+        return server.noop()[0] == 250
+    except smtplib.SMTPException:
+        return False
+
+
+def make_server(config):
+    server = config['MAIL_SERVER']
+    port = config['MAIL_PORT']
+    if config.get('MAIL_USE_SSL'):
+        client = smtplib.SMTP_SSL(server, port)
+    else:
+        client = smtplib.SMTP(server, port)
+
+    if config.get('MAIL_USE_TLS'):
+        client.ehlo()
+        client.starttls()
+        client.ehlo()
+
+    return client
+
+
+smtp_pool = SmtpPool()
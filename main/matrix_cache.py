@@ -0,0 +1,189 @@
+"""Redis cache for distance matrices, keyed on the rounded coordinate set and the planning type."""
+import hashlib
+import io
+import json
+import os
+import time
+import zlib
+
+import numpy as np
+
+COORDINATE_DECIMALS = 5  # ~1m
+DEFAULT_TTL = int(os.getenv('MATRIX_CACHE_TTL', 7 * 24 * 60 * 60))
+DEFAULT_MAX_BYTES = int(os.getenv('MATRIX_CACHE_MAX_BYTES', 20 * 1024 * 1024))
+DEFAULT_MIN_OVERLAP = 0.8
+
+KEY_PREFIX = 'matrix_cache:'
+LRU_KEY = KEY_PREFIX + 'lru'
+SIZES_KEY = KEY_PREFIX + 'sizes'
+STATS_KEY = KEY_PREFIX + 'stats'
+
+HIT = 'hit'
+SUPERSET_HIT = 'superset_hit'
+PARTIAL_HIT = 'partial_hit'
+MISS = 'miss'
+
+
+def rounded_coordinates(addresses):
+    return [(round(float(item['lon']), COORDINATE_DECIMALS), round(float(item['lat']), COORDINATE_DECIMALS))
+            for item in addresses]
+
+
+def entry_id(coordinates, planning_type):
+    digest = hashlib.sha1(json.dumps(sorted(set(coordinates))).encode('utf-8')).hexdigest()
+    return planning_type + ':' + digest
+
+
+def encode_matrix(matrix):
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(matrix, dtype=np.float32), allow_pickle=False)
+    return zlib.compress(buffer.getvalue())
+
+
+def decode_matrix(blob):
+    return np.load(io.BytesIO(zlib.decompress(blob)), allow_pickle=False).astype(np.float64)
+
+
+class MatrixCache(object):
+    """
+    Stores duration matrices in redis with a ttl per entry and evicts least recently used entries once the stored
+    matrices exceed max_bytes.
+
+    A request whose points are all contained in a cached matrix is cut out of it. If at least min_overlap of the
+    points are known, only the rows and columns of the new points are fetched.
+    """
+
+    def __init__(self, connection, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, min_overlap=DEFAULT_MIN_OVERLAP):
+        self.connection = connection
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.min_overlap = min_overlap
+        self.last_lookup = None
+
+    def get_or_fetch(self, addresses, planning_type, fetch):
+        """
+        Returns the duration matrix for the addresses in their order.
+
+        fetch(locations, sources, destinations) must return the durations from the locations at the source
+        indices to those at the destination indices as nested lists.
+        """
+        coordinates = rounded_coordinates(addresses)
+        unique = list(dict.fromkeys(coordinates))
+        position = dict((coordinate, idx) for idx, coordinate in enumerate(unique))
+        order = [position[coordinate] for coordinate in coordinates]
+
+        key = entry_id(unique, planning_type)
+        cached = self._load(key)
+        if cached:
+            status, fetched_cells = HIT, 0
+            matrix = submatrix(cached, unique)
+        else:
+            candidate = self._best_candidate(unique, planning_type)
+            known = [coordinate in candidate[1] for coordinate in unique] if candidate else []
+            if candidate and all(known):
+                status, fetched_cells = SUPERSET_HIT, 0
+                matrix = submatrix(candidate, unique)
+            elif candidate and sum(known) >= self.min_overlap * len(unique):
+                status = PARTIAL_HIT
+                matrix, fetched_cells = self._complete(candidate, unique, known, fetch)
+                self._store(key, unique, matrix)
+            else:
+                status, fetched_cells = MISS, len(unique) * len(unique)
+                all_idx = list(range(len(unique)))
+                matrix = np.array(fetch(as_locations(unique), all_idx, all_idx), dtype=np.float64)
+                self._store(key, unique, matrix)
+
+        self.last_lookup = {'status': status, 'size': len(unique), 'fetched_cells': fetched_cells}
+        self.connection.hincrby(STATS_KEY, status, 1)
+        return matrix[np.ix_(order, order)]
+
+    def stats(self):
+        counters = self.connection.hgetall(STATS_KEY)
+        return dict((key.decode('utf-8'), int(value)) for key, value in counters.items())
+
+    def _complete(self, candidate, unique, known, fetch):
+        cached_matrix, cached_position = candidate
+        known_idx = [idx for idx, is_known in enumerate(known) if is_known]
+        missing_idx = [idx for idx, is_known in enumerate(known) if not is_known]
+        all_idx = list(range(len(unique)))
+        locations = as_locations(unique)
+
+        matrix = np.empty((len(unique), len(unique)), dtype=np.float64)
+        cached_idx = [cached_position[unique[idx]] for idx in known_idx]
+        matrix[np.ix_(known_idx, known_idx)] = cached_matrix[np.ix_(cached_idx, cached_idx)]
+        matrix[missing_idx, :] = fetch(locations, missing_idx, all_idx)
+        matrix[np.ix_(known_idx, missing_idx)] = fetch(locations, known_idx, missing_idx)
+        return matrix, len(missing_idx) * (len(unique) + len(known_idx))
+
+    def _load(self, key):
+        blob, coordinates = self.connection.mget(KEY_PREFIX + 'matrix:' + key, KEY_PREFIX + 'coords:' + key)
+        if blob is None or coordinates is None:
+            return None
+        self.connection.zadd(LRU_KEY, {key: time.time()})
+        return decode_matrix(blob), position_of(coordinates)
+
+    def _best_candidate(self, unique, planning_type):
+        keys = [key.decode('utf-8') for key in self.connection.zrange(LRU_KEY, 0, -1)]
+        keys = [key for key in keys if key.startswith(planning_type + ':')]
+        if not keys:
+            return None
+        coordinate_lists = self.connection.mget([KEY_PREFIX + 'coords:' + key for key in keys])
+
+        requested = set(unique)
+        best_key, best_overlap = None, 0
+        for key, coordinates in zip(keys, coordinate_lists):
+            if coordinates is None:
+                continue
+            overlap = len(requested.intersection(position_of(coordinates)))
+            if overlap > best_overlap:
+                best_key, best_overlap = key, overlap
+        return self._load(best_key) if best_key else None
+
+    def _store(self, key, unique, matrix):
+        blob = encode_matrix(matrix)
+        coordinates = json.dumps(unique)
+        pipeline = self.connection.pipeline()
+        pipeline.set(KEY_PREFIX + 'matrix:' + key, blob, ex=self.ttl)
+        pipeline.set(KEY_PREFIX + 'coords:' + key, coordinates, ex=self.ttl)
+        pipeline.zadd(LRU_KEY, {key: time.time()})
+        pipeline.hset(SIZES_KEY, key, len(blob) + len(coordinates))
+        pipeline.execute()
+        self._evict()
+
+    def _evict(self):
+        """Drops index entries of expired matrices and the least recently used ones beyond max_bytes."""
+        keys = [key.decode('utf-8') for key in self.connection.zrange(LRU_KEY, 0, -1)]
+        pipeline = self.connection.pipeline()
+        for key in keys:
+            pipeline.exists(KEY_PREFIX + 'matrix:' + key)
+        alive = pipeline.execute()
+        sizes = dict((key.decode('utf-8'), int(size)) for key, size in self.connection.hgetall(SIZES_KEY).items())
+
+        total = sum(sizes.get(key, 0) for key, is_alive in zip(keys, alive) if is_alive)
+        evicted = [key for key, is_alive in zip(keys, alive) if not is_alive]
+        for key, is_alive in zip(keys, alive):
+            if is_alive and total > self.max_bytes:
+                evicted.append(key)
+                total -= sizes.get(key, 0)
+        if not evicted:
+            return
+        pipeline = self.connection.pipeline()
+        for key in evicted:
+            pipeline.delete(KEY_PREFIX + 'matrix:' + key, KEY_PREFIX + 'coords:' + key)
+        pipeline.zrem(LRU_KEY, *evicted)
+        pipeline.hdel(SIZES_KEY, *evicted)
+        pipeline.execute()
+
+
+def submatrix(cached, unique):
+    cached_matrix, cached_position = cached
+    idx = [cached_position[coordinate] for coordinate in unique]
+    return cached_matrix[np.ix_(idx, idx)]
+
+
+def position_of(coordinates_json):
+    return dict((tuple(coordinate), idx) for idx, coordinate in enumerate(json.loads(coordinates_json)))
+
+
+def as_locations(coordinates):
+    return [{'lon': lon, 'lat': lat} for lon, lat in coordinates]
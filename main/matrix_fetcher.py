@@ -0,0 +1,149 @@
+"""Fetches large duration matrices as concurrent source/destination tiles."""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT = 30
+MAX_RETRY_AFTER = 120  # seconds, longer waits fail the tile
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class TileRequestError(ConnectionError):
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        super(TileRequestError, self).__init__(status_code, text)
+
+
+class OrsEndpoint(object):
+    """openrouteservice matrix API, tiles are POSTed with sources and destinations."""
+
+    def __init__(self, url, api_key, tile_size=50):
+        self.url = url
+        self.api_key = api_key
+        self.tile_size = tile_size
+
+    def request(self, session, locations, sources, destinations, timeout):
+        data = json.dumps({"locations": [[item['lon'], item['lat']] for item in locations],
+                           "sources": sources, "destinations": destinations, "metrics": ["duration"]})
+        headers = {"Authorization": "Bearer " + self.api_key, 'Accept-Encoding': 'UTF-8',
+                   'Content-Type': 'application/json', 'Accept': '*/*'}
+        return session.post(self.url, data=data, headers=headers, timeout=timeout)
+
+
+class OsrmEndpoint(object):
+    """OSRM table service, tiles are GET requests restricted by the sources and destinations parameters."""
+
+    def __init__(self, url, tile_size=50):
+        self.url = url
+        self.tile_size = tile_size
+
+    def request(self, session, locations, sources, destinations, timeout):
+        coordinates = ';'.join(str(item['lon']) + ',' + str(item['lat']) for item in locations)
+        params = {'sources': ';'.join(map(str, sources)), 'destinations': ';'.join(map(str, destinations)),
+                  'annotations': 'duration'}
+        return session.get(self.url.format(coordinates), params=params, timeout=timeout)
+
+
+class TiledMatrixFetcher(object):
+    """
+    Splits the requested matrix into tiles of at most tile_size sources and destinations, fetches them with a pooled
+    session on max_workers threads and assembles the result. Each tile only sends the locations it needs. Failed
+    tiles are retried with exponential backoff on connection errors, timeouts and the RETRY_STATUS_CODES. A
+    Retry-After header of a 429 or 503 pauses all tiles of the fetcher until then. A fetcher is meant to be kept, it
+    can be shared by threads.
+    """
+
+    def __init__(self, endpoint, max_workers=DEFAULT_MAX_WORKERS, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 timeout=DEFAULT_TIMEOUT, session=None):
+        self.endpoint = endpoint
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = session or pooled_session(max_workers)
+        self.resume_at = 0
+
+    def fetch(self, locations, sources=None, destinations=None):
+        """Returns the durations from the locations at the source indices to those at the destination indices."""
+        sources = list(range(len(locations))) if sources is None else list(sources)
+        destinations = list(range(len(locations))) if destinations is None else list(destinations)
+        tiles = [(source_tile, destination_tile)
+                 for source_tile in chunks(range(len(sources)), self.endpoint.tile_size)
+                 for destination_tile in chunks(range(len(destinations)), self.endpoint.tile_size)]
+
+        def fetch_tile(tile):
+            source_tile, destination_tile = tile
+            return self._fetch_tile(locations, [sources[i] for i in source_tile],
+                                    [destinations[j] for j in destination_tile])
+
+        matrix = np.empty((len(sources), len(destinations)), dtype=np.float64)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for (source_tile, destination_tile), durations in zip(tiles, executor.map(fetch_tile, tiles)):
+                matrix[source_tile[0]:source_tile[-1] + 1, destination_tile[0]:destination_tile[-1] + 1] = durations
+        return matrix
+
+    def _fetch_tile(self, locations, sources, destinations):
+        tile_nodes = list(dict.fromkeys(sources + destinations))
+        position = dict((node, idx) for idx, node in enumerate(tile_nodes))
+        tile_locations = [locations[node] for node in tile_nodes]
+        tile_sources = [position[node] for node in sources]
+        tile_destinations = [position[node] for node in destinations]
+
+        for attempt in range(self.retries + 1):
+            pause = self.resume_at - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.endpoint.request(self.session, tile_locations, tile_sources, tile_destinations,
+                                                 self.timeout)
+                if response.status_code == 200:
+                    return np.array(response.json()['durations'], dtype=np.float64)
+                error = TileRequestError(response.status_code, response.text)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise error
+                retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+                if retry_after is not None:
+                    if retry_after > MAX_RETRY_AFTER:
+                        raise error
+                    delay = max(delay, retry_after)
+                    self.resume_at = max(self.resume_at, time.time() + retry_after)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(delay)
+        raise error
+
+
+def retry_after_seconds(value):
+    """Seconds of a Retry-After header, given as seconds or as http date, None if there is none."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def pooled_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def chunks(items, size):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
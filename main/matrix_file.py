@@ -0,0 +1,133 @@
+"""
+Binary files for duration matrices: an int32 .npy array, read memory-mapped, next to a small json metadata header with
+the planning type, the hash of the coordinates and the order of the nodes. Json matrix files are read as before.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from main.constants import MAX_TIME_DURATION
+from main.matrix_cache import rounded_coordinates
+
+BINARY_SUFFIX = '.npy'
+METADATA_SUFFIX = '.meta.json'
+FORMAT_VERSION = 1
+
+
+def is_binary(path):
+    return path.endswith(BINARY_SUFFIX)
+
+
+def binary_path(path):
+    """The path of the binary matrix file next to the json matrix file path."""
+    return path if is_binary(path) else os.path.splitext(path)[0] + BINARY_SUFFIX
+
+
+def metadata_path(path):
+    return path[:-len(BINARY_SUFFIX)] + METADATA_SUFFIX
+
+
+def coordinate_hash(coordinates):
+    """Hash of the rounded coordinates in node order, unlike matrix_cache.entry_id the order matters."""
+    return hashlib.sha1(json.dumps(coordinates).encode('utf-8')).hexdigest()
+
+
+def save_matrix(path, durations, addresses, planning_type):
+    """
+    Writes the durations between the addresses as int32 array to the binary file path and its metadata next to it.
+    Unreachable pairs, nan in the durations, are stored as MAX_TIME_DURATION, which blocks them like time_matrix does.
+    """
+    if addresses is None:
+        raise ValueError('The addresses of the matrix are needed for the metadata of ' + path)
+    durations = np.asarray(durations, dtype=np.float64)
+    if durations.shape != (len(addresses), len(addresses)):
+        raise ValueError('Matrix of shape {} for {} addresses'.format(durations.shape, len(addresses)))
+    coordinates = [list(coordinate) for coordinate in rounded_coordinates(addresses)]
+    np.save(path, np.where(np.isnan(durations), MAX_TIME_DURATION, np.rint(durations)).astype(np.int32),
+            allow_pickle=False)
+    with open(metadata_path(path), 'w') as outfile:
+        json.dump({'version': FORMAT_VERSION, 'planning_type': planning_type, 'size': len(addresses),
+                   'coordinate_hash': coordinate_hash(coordinates), 'nodes': coordinates}, outfile)
+
+
+def durations_array(dist_matrix):
+    """
+    The durations of the dist matrix as array: integer ones, like the memory-mapped durations of a binary file, as they
+    are without a copy, others as float64 array with nan for missing durations.
+    """
+    durations = dist_matrix['durations']
+    if isinstance(durations, np.ndarray) and np.issubdtype(durations.dtype, np.integer):
+        return durations
+    return np.asarray(durations, dtype=np.float64)
+
+
+def load_metadata(path):
+    with open(metadata_path(path)) as infile:
+        return json.load(infile)
+
+
+def load_matrix(path, addresses=None, planning_type=None):
+    """
+    Reads the dist matrix dict of a binary or json matrix file. The durations of a binary file are memory-mapped, with
+    addresses they are cut down to the matrix of these addresses, see node_positions. A planning type differing from
+    the one in the metadata raises a ValueError.
+    """
+    if not is_binary(path):
+        with open(path) as infile:
+            return json.load(infile)
+
+    metadata = load_metadata(path)
+    if planning_type and metadata['planning_type'] != planning_type:
+        raise ValueError('The matrix in {} is for {}, not for {}'.format(path, metadata['planning_type'],
+                                                                         planning_type))
+    durations = np.load(path, mmap_mode='r', allow_pickle=False)
+    if addresses is not None:
+        durations = submatrix(durations, node_positions(metadata, addresses))
+    return {'durations': durations}
+
+
+def node_positions(metadata, addresses):
+    """The nodes of the matrix the addresses are at, a slice if they are evenly spaced, else a list of nodes."""
+    coordinates = [list(coordinate) for coordinate in rounded_coordinates(addresses)]
+    if coordinate_hash(coordinates) == metadata['coordinate_hash']:
+        return slice(None)
+
+    free_nodes = {}
+    for node, coordinate in enumerate(metadata['nodes']):
+        free_nodes.setdefault(tuple(coordinate), []).append(node)
+    positions = []
+    for address, coordinate in zip(addresses, coordinates):
+        candidates = free_nodes.get(tuple(coordinate))
+        if not candidates:
+            raise ValueError('No node of the matrix file at the coordinates of {}'.format(address))
+        positions.append(candidates.pop(0))
+
+    steps = set(np.diff(positions).tolist())
+    if len(positions) > 1 and len(steps) == 1 and steps.pop() > 0:
+        return slice(positions[0], positions[-1] + 1, positions[1] - positions[0])
+    return positions
+
+
+def submatrix(durations, positions):
+    """A view of the memory-mapped durations for a slice, only the rows and columns of a list of nodes are read."""
+    if isinstance(positions, slice):
+        return durations[positions, positions]
+    return durations[np.ix_(positions, positions)]
+
+
+def open_matrix(path, addresses, planning_type):
+    """
+    The dist matrix of the addresses from the matrix file path. A json file is converted once to a binary file next to
+    it, which is mapped instead as long as it is newer than the json file, if it holds the matrix of the addresses.
+    """
+    if is_binary(path):
+        return load_matrix(path, addresses, planning_type)
+    converted = binary_path(path)
+    if os.path.exists(converted) and os.path.getmtime(converted) >= os.path.getmtime(path):
+        return load_matrix(converted, addresses, planning_type)
+    dist_matrix = load_matrix(path)
+    if len(dist_matrix['durations']) == len(addresses):
+        save_matrix(converted, dist_matrix['durations'], addresses, planning_type)
+    return dist_matrix
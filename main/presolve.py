@@ -0,0 +1,155 @@
+"""Presolve: vehicle domains, a tight horizon and a diagnosis of constraints no solution can meet."""
+import numpy as np
+
+from main.constants import MAX_TIME_DURATION
+
+
+class InfeasibleConstraints(ValueError):
+    """The constraints cannot be met, reasons lists every conflict found."""
+
+    def __init__(self, reasons):
+        self.reasons = reasons
+        super(InfeasibleConstraints, self).__init__('Infeasible constraints: ' + '; '.join(reasons))
+
+
+def presolve(data):
+    """
+    Returns the allowed_vehicles of every stop with a restricted vehicle domain and the horizon for the time dimension
+    of the data of create_data_model. Raises InfeasibleConstraints listing all conflicts found.
+    """
+    reasons = []
+    allowed = allowed_vehicles(data, reasons)
+    reasons += reachability_conflicts(data)
+    if reasons:
+        raise InfeasibleConstraints(reasons)
+    return {'allowed_vehicles': allowed, 'horizon': horizon(data)}
+
+
+def check_structure(json_constraints):
+    """Raises InfeasibleConstraints if assign_to_route, same_route(_ordered), fixed_arcs and different_route conflict;
+    needs no durations."""
+    reasons = []
+    allowed_vehicles(json_constraints, reasons)
+    if reasons:
+        raise InfeasibleConstraints(reasons)
+
+
+def allowed_vehicles(json_constraints, reasons):
+    """
+    Stops joined by same_route, same_route_ordered or fixed_arcs share one vehicle domain, which is narrowed by the
+    assign_to_route entries of its stops and, while a different_route partner is bound to a single vehicle, by that
+    vehicle. Returns node -> sorted vehicles for every stop whose domain is not all vehicles and appends a reason
+    for every empty domain.
+    """
+    num_vehicles = json_constraints['num_vehicles']
+    depot = json_constraints['depot']
+    all_vehicles = set(range(num_vehicles))
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for group in list(json_constraints['same_route']) + list(json_constraints['same_route_ordered']) + \
+            list(json_constraints['fixed_arcs']):
+        for node1, node2 in zip(group, group[1:]):
+            parent[find(node1)] = find(node2)
+
+    assigned = {}
+    for vehicle, route_assignment in enumerate(json_constraints['assign_to_route']):
+        for node in route_assignment:
+            if vehicle >= num_vehicles:
+                reasons.append('stop {} is assigned to route {}, but there are only {} vehicles'.format(
+                    node, vehicle, num_vehicles))
+            assigned.setdefault(node, set()).add(vehicle)
+    for node, vehicles in sorted(assigned.items()):
+        if len(vehicles) > 1:
+            reasons.append('stop {} is assigned to routes {}'.format(node, sorted(vehicles)))
+
+    members, domains = {}, {}
+    for node in set(parent) | set(assigned):
+        members.setdefault(find(node), []).append(node)
+    for root, nodes in members.items():
+        domain = set(all_vehicles)
+        for node in nodes:
+            domain &= assigned.get(node, all_vehicles)
+        domains[root] = domain
+        assignments = dict((node, sorted(assigned[node])) for node in sorted(nodes) if node in assigned)
+        if not domain and len(nodes) > 1 and len(set(map(tuple, assignments.values()))) > 1:
+            reasons.append('stops {} have to share a route, but are assigned to routes {}'.format(
+                sorted(nodes), assignments))
+
+    pairs = []
+    for node1, node2 in json_constraints['different_route']:
+        if find(node1) == find(node2):
+            reasons.append('stops {} and {} have to be on different routes, but same_route, same_route_ordered or '
+                           'fixed_arcs join them'.format(node1, node2))
+        else:
+            pairs.append((node1, node2))
+    changed = True
+    while changed:
+        changed = False
+        for node1, node2 in pairs:
+            for node, partner in [(node1, node2), (node2, node1)]:
+                domain, partner_domain = domains.setdefault(find(node), set(all_vehicles)), \
+                                         domains.setdefault(find(partner), set(all_vehicles))
+                if len(domain) == 1 and domain & partner_domain:
+                    partner_domain -= domain
+                    changed = True
+                    if not partner_domain:
+                        reasons.append('stops {} and {} have to be on different routes, but both can only use '
+                                       'route {}'.format(node, partner, next(iter(domain))))
+
+    return dict((node, sorted(domains[find(node)])) for node in parent.keys() | assigned.keys()
+                if node != depot and find(node) in domains and domains[find(node)] != all_vehicles)
+
+
+def reachability_conflicts(data):
+    """Stops which cannot be reached or left at all, or not within their time window."""
+    time = data['time_matrix']
+    depot = data['depot']
+    if len(time) < 2:
+        return []
+    blocked = time >= MAX_TIME_DURATION
+    np.fill_diagonal(blocked, True)
+    reasons = ['stop {} cannot be reached from any other stop'.format(node)
+               for node in np.flatnonzero(blocked.all(axis=0))]
+    reasons += ['stop {} cannot be left to any other stop'.format(node)
+                for node in np.flatnonzero(blocked.all(axis=1))]
+
+    time_windows = data['time_windows']
+    if not time_windows:
+        return reasons
+    if 0 not in time_windows:
+        return reasons + ['time windows need the window of the vehicle starts under key 0']
+    depot_start = time_windows[0][0]
+    for key, (start, end) in time_windows.items():
+        if start > end:
+            reasons.append('time window of {} opens at {} after it closes at {}'.format(key, start, end))
+        elif isinstance(key, str) and int(key) != depot and not blocked[depot, int(key)]:
+            earliest = depot_start + int(time[depot, int(key)])
+            if earliest > end:
+                reasons.append('time window of stop {} closes at {}, but it can be reached at {} at the '
+                               'earliest'.format(key, end, earliest))
+    return reasons
+
+
+def horizon(data):
+    """
+    Upper bound for the time a route can take without using a blocked arc: every node is left at most once, over its
+    longest open arc, plus the latest time window bound when routes do not start at zero. Never above the former
+    bound of the longest arc and dwell duration per node.
+    """
+    time = data['time_matrix']
+    no_visits = len(time)
+    greatest_dwell_time = max(data['dwell_duration'].values())
+    loose = int((int(time.max()) + greatest_dwell_time) * no_visits + 1) + 1
+
+    open_arcs = np.where(time < MAX_TIME_DURATION, time, 0)
+    tight = int(open_arcs.max(axis=1).sum())
+    if data['time_windows']:
+        tight += max(max(window) for window in data['time_windows'].values())
+    return min(tight + 1, loose)
@@ -0,0 +1,55 @@
+"""Opt-in cProfile capture of jobs, kept as compressed pstats data in redis."""
+import cProfile
+import marshal
+import os
+import zlib
+
+PROFILE_JOBS = os.getenv('VRP_PROFILE', '') == '1'
+PROFILE_TTL = int(os.getenv('VRP_PROFILE_TTL', 24 * 60 * 60))
+SORT_KEYS = {'cumulative': 3, 'tottime': 2, 'calls': 1}
+
+
+def profile_key(job_id):
+    return 'vrp:profile:' + job_id
+
+
+def profiling_requested(json_constraints):
+    """Profile the job if its constraints set profile to true or the worker runs with VRP_PROFILE=1."""
+    return PROFILE_JOBS or bool(json_constraints.get('profile'))
+
+
+def start_profiler():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def store_profile(connection, job_id, profiler):
+    """Stops the profiler and stores its stats in the format of pstats dump files. Processes started by the job,
+    e.g. for a solver portfolio, are not part of it."""
+    profiler.disable()
+    profiler.create_stats()
+    connection.set(profile_key(job_id), zlib.compress(marshal.dumps(profiler.stats)), ex=PROFILE_TTL)
+
+
+def load_profile(connection, job_id):
+    """The pstats dump of the job, None if it was not profiled or the profile expired."""
+    data = connection.get(profile_key(job_id))
+    return zlib.decompress(data) if data else None
+
+
+def summarize(pstats_dump, top=20, sort='cumulative'):
+    """The top functions of a pstats dump by cumulative time, own time or calls."""
+    stats = marshal.loads(pstats_dump)
+    column = SORT_KEYS.get(sort, SORT_KEYS['cumulative'])
+    rows = sorted(stats.items(), key=lambda item: item[1][column], reverse=True)[:top]
+    return {
+        'total_seconds': round(sum(row[2] for row in stats.values()), 3),
+        'functions': [{
+            'function': '{}:{}({})'.format(*function),
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'tottime': round(tottime, 4),
+            'cumtime': round(cumtime, 4),
+        } for function, (primitive_calls, calls, tottime, cumtime, _) in rows]
+    }
@@ -0,0 +1,166 @@
+"""Publishes improving solutions of a running search and lets clients stop it early."""
+import time
+from queue import Empty
+
+from main.events import publish_event
+
+DEFAULT_PUBLISH_INTERVAL = 2.0
+DEFAULT_STOP_CHECK_INTERVAL = 1.0
+STOP_KEY_TTL = 60 * 60
+
+
+def stop_key(job_id):
+    return 'vrp:stop:' + job_id
+
+
+def request_stop(connection, job_id):
+    """Asks the search of the job to finish and return its current best solution."""
+    connection.set(stop_key(job_id), 1, ex=STOP_KEY_TTL)
+
+
+class JobProgress(object):
+    """Writes progress into job.meta['progress'] and reads stop requests for the job from redis."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def publish(self, progress):
+        self.job.meta['progress'] = progress
+        self.job.save_meta()
+        publish_event(self.job.connection, self.job.id, 'progress', progress)
+
+    def stop_requested(self):
+        return bool(self.job.connection.exists(stop_key(self.job.id)))
+
+
+class ExpandingProgress(object):
+    """Passes progress of a search on a Contraction to progress with the routes expanded to the original nodes."""
+
+    def __init__(self, progress, contraction):
+        self.progress = progress
+        self.contraction = contraction
+
+    def publish(self, progress):
+        self.progress.publish(dict(progress, routes=self.contraction.expand(progress['routes'])))
+
+    def stop_requested(self):
+        return self.progress.stop_requested()
+
+
+class RelayedProgress(object):
+    """
+    Progress of a search in a portfolio worker process: solutions go to a manager queue and stop requests are read
+    from a manager event, relay_progress passes them on in the parent process.
+    """
+
+    def __init__(self, queue, stop_event, strategy):
+        self.queue = queue
+        self.stop_event = stop_event
+        self.strategy = strategy
+
+    def publish(self, progress):
+        self.queue.put(dict(progress, strategy=self.strategy))
+
+    def stop_requested(self):
+        return self.stop_event.is_set()
+
+
+def relay_progress(futures, queue, stop_event, progress, poll_interval=DEFAULT_STOP_CHECK_INTERVAL):
+    """
+    Publishes the solutions the RelayedProgress of the workers report to progress until all futures are done, if
+    they improve on the best one so far, and sets stop_event once progress.stop_requested().
+    """
+    best = None
+    done = False
+    while not done:
+        done = all(future.done() for future in futures)
+        try:
+            solution = queue.get(timeout=poll_interval) if not done else queue.get_nowait()
+        except Empty:
+            solution = None
+        if solution:
+            done = False  # drain the queue before returning
+            if best is None or solution['objective'] < best['objective']:
+                best = solution
+                progress.publish(solution)
+        if not stop_event.is_set() and progress.stop_requested():
+            stop_event.set()
+
+
+class SolutionReporter(object):
+    """
+    Search monitor for a routing model: records every improving solution as compact node routes and passes the
+    latest one to progress.publish, at most every publish_interval seconds; a solution held back by that is published
+    on one of the next stop checks. The search finishes with its current best solution once progress.stop_requested(),
+    which is polled at most every stop_check_interval seconds. Without progress it only counts the solutions, and
+    those improving on the best objective so far, and times the first one.
+    """
+
+    def __init__(self, manager, routing, progress, publish_interval=DEFAULT_PUBLISH_INTERVAL,
+                 stop_check_interval=DEFAULT_STOP_CHECK_INTERVAL):
+        self.manager = manager
+        self.routing = routing
+        self.progress = progress
+        self.publish_interval = publish_interval
+        self.stop_check_interval = stop_check_interval
+        self.start = time.time()
+        self.solutions = 0
+        self.improvements = 0
+        self.best_objective = None
+        self.first_solution_elapsed = None
+        self.best = None
+        self.published = None
+        self.last_publish = 0
+        self.last_stop_check = 0
+        self.stopped = False
+
+    def attach(self):
+        self.routing.AddAtSolutionCallback(self.on_solution)
+        if self.progress:
+            self.routing.AddSearchMonitor(self.routing.solver().CustomLimit(self.should_stop))
+        return self
+
+    def on_solution(self):
+        self.solutions += 1
+        if self.first_solution_elapsed is None:
+            self.first_solution_elapsed = round(time.time() - self.start, 3)
+        objective = self.routing.CostVar().Value()
+        improving = self.best_objective is None or objective < self.best_objective
+        if improving:
+            self.improvements += 1
+            self.best_objective = objective
+        if not self.progress:
+            return
+        if improving:
+            self.best = {'objective': objective, 'routes': self.current_routes(),
+                         'elapsed': round(time.time() - self.start, 3), 'solutions': self.solutions,
+                         'branches': self.routing.solver().Branches()}
+        if time.time() - self.last_publish >= self.publish_interval:
+            self.publish()
+
+    def should_stop(self):
+        now = time.time()
+        if not self.stopped and now - self.last_stop_check >= self.stop_check_interval:
+            self.last_stop_check = now
+            self.stopped = self.progress.stop_requested()
+            if now - self.last_publish >= self.publish_interval:
+                self.publish()
+        return self.stopped
+
+    def publish(self):
+        """Publishes the best solution if it was not published yet."""
+        if self.best is not None and self.best is not self.published:
+            self.last_publish = time.time()
+            self.published = self.best
+            self.progress.publish(dict(self.best, stopped=self.stopped))
+
+    def current_routes(self):
+        routes = []
+        for vehicle_id in range(self.routing.vehicles()):
+            index = self.routing.Start(vehicle_id)
+            route = [self.manager.IndexToNode(index)]
+            while not self.routing.IsEnd(index):
+                index = self.routing.NextVar(index).Value()
+                route.append(self.manager.IndexToNode(index))
+            routes.append(route)
+        return routes
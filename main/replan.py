@@ -0,0 +1,100 @@
+"""Incremental re-planning: stops added late are inserted into the routes of an earlier job."""
+import numpy as np
+
+from main.constants import MAX_TIME_DURATION
+from main.decompose import sub_instance, route_to_global
+from main.matrix_cache import MISS
+from main.presolve import presolve
+from main.run_algorithm import create_data_model, solve, format_routes
+from main.solution import earliest_arrivals, window_vectors
+from main.telemetry import timed
+from main.warm_start import repair_routes, vehicles_of
+
+
+def replan_runner(dist_matrix, json_constraints, json_addresses, statistics=None, progress=None, new_nodes=(),
+                  improve_timeout=0, matrix_cache=None):
+    """
+    Like run_algorithm.mainrunner, but re-plans json_constraints['initial_routes'] with replan. The lookup of the
+    matrix_cache which fetched dist_matrix goes to statistics['replan']['matrix'], with 'full_fetch' set if the matrix
+    of the earlier job was no longer cached and all cells were fetched.
+    """
+    statistics = {} if statistics is None else statistics
+    routes = replan(dist_matrix, json_constraints, new_nodes, improve_timeout, statistics)
+    if matrix_cache and matrix_cache.last_lookup:
+        lookup = matrix_cache.last_lookup
+        statistics['replan']['matrix'] = dict(lookup, full_fetch=lookup['status'] == MISS)
+        if lookup['status'] == MISS:
+            print("Replan: matrix of the earlier job not cached, fetched all " + str(lookup['fetched_cells']) +
+                  " cells")
+    return format_routes(dist_matrix, json_constraints, json_addresses, routes, statistics)
+
+
+def replan(dist_matrix, json_constraints, new_nodes, improve_timeout=0, statistics=None):
+    """
+    Inserts the new_nodes into json_constraints['initial_routes'], the routes of node indices of an earlier job,
+    each at the cheapest position keeping the time windows of its route, like stops of the earlier routes which now
+    violate a constraint. Then the routes which got new stops are solved again for improve_timeout seconds, started
+    from their stops, unless it is 0. Returns routes of node indices like run_algorithm.solve, statistics['replan']
+    tells what was done. statistics['objective'] stays unset, the totals of the final routes come from format_routes.
+    """
+    statistics = {} if statistics is None else statistics
+    phases = statistics.setdefault('phases', {})
+    with timed(phases, 'create_data_model'):
+        data = create_data_model(dist_matrix, json_constraints)
+    with timed(phases, 'presolve'):
+        data.update(presolve(data))
+
+    with timed(phases, 'insertion'):
+        feasible = schedule_check(data)
+        routes, inserted = repair_routes(data['initial_routes'], data, feasible)
+    vehicle_of = vehicles_of(routes)
+    affected = sorted(set(vehicle_of[node] for node in new_nodes if node in vehicle_of))
+    statistics['replan'] = {'new_stops': len(new_nodes), 'reinserted_stops': inserted - len(new_nodes),
+                            'affected_routes': affected,
+                            'infeasible_routes': [vehicle for vehicle in affected if not feasible(routes[vehicle])]}
+
+    if improve_timeout > 0 and affected:
+        with timed(phases, 'improvement'):
+            improved, objective = improve(dist_matrix, json_constraints, routes, affected, improve_timeout)
+        # the objective of the affected routes only, not of the whole plan, so it is no job objective
+        statistics['replan'].update(improved=bool(improved), improved_objective=objective)
+        for vehicle, route in zip(affected, improved):
+            routes[vehicle] = route[1:-1]
+
+    depot = data['depot']
+    return [[depot] + route + [depot] for route in routes]
+
+
+def schedule_check(data):
+    """
+    Returns a check whether a route of stops, in the time matrix of data, can be driven without a blocked arc,
+    reaching every stop before its time window closes and the depot within the horizon. The window of the depot only
+    fixes the start, like in add_time_windows.
+    """
+    time = data['time_matrix']
+    depot = data['depot']
+    horizon = data['horizon']
+    opens, closes = window_vectors(len(time), data['time_windows'])
+    start = opens[depot] if np.isfinite(opens[depot]) else 0
+
+    def feasible(route):
+        nodes = np.array([depot] + route + [depot], dtype=np.intp)
+        legs = time[nodes[:-1], nodes[1:]]
+        if legs.max() >= MAX_TIME_DURATION:
+            return False
+        arrivals = earliest_arrivals(legs, opens[nodes], start)
+        return bool(np.all(arrivals[1:-1] <= closes[nodes[1:-1]]) and arrivals[-1] <= horizon)
+
+    return feasible
+
+
+def improve(dist_matrix, json_constraints, routes, vehicles, timeout):
+    """Solves the stops of the routes of the vehicles again, started from these routes. Returns the improved routes
+    of global nodes with the depot at both ends, [] if the solver found none, and the objective."""
+    durations = np.asarray(dist_matrix['durations'], dtype=np.float64)
+    stops = [node for vehicle in vehicles for node in routes[vehicle]]
+    local_matrix, constraints, nodes = sub_instance(durations, json_constraints, stops, vehicles, timeout,
+                                                    [routes[vehicle] for vehicle in vehicles])
+    statistics = {}
+    improved = solve(local_matrix, constraints, statistics)
+    return [route_to_global(route, nodes) for route in improved], statistics.get('objective')
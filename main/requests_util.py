@@ -1,8 +1,11 @@
-import json
-from functools import reduce
+import os
+from functools import reduce, lru_cache
 
 import requests
 
+from main.geocoding import Geocoder
+from main.matrix_fetcher import TiledMatrixFetcher, OrsEndpoint, OsrmEndpoint
+
 OPEN_ROUTES_URL_MATRIX = "https://api.openrouteservice.org/v2/matrix/"
 OPEN_ROUTES_URL_COORDINATES = "https://api.openrouteservice.org/geocode/search/structured"
 OPEN_ROUTES_URL_COORDINATES2 = "https://api.openrouteservice.org/geocode/search"
@@ -14,8 +17,7 @@ MAPBOX_QUERY = 'https://' + 'api.mapbox.com' + '/directions-matrix/v1/mapbox/wal
                                                '.eyJ1IjoiZGFuZGVsaW4iLCJhIjoiY2s0NzFybHJqMGFpYTNrcWxmanp2b2tzcyJ9.XQN' \
                                                '-K3gC4ON6D75A361b1g'
 
-HEADER = {"Authorization": "Bearer {}", 'Accept-Encoding': 'UTF-8', 'Content-Type': 'application/json',
-          'Accept': '*/*'}
+GEOCODE_RATE = float(os.getenv('GEOCODE_RATE', 1.5))  # openrouteservice allows 100 geocoding requests per minute
 
 
 def open_routes_url_matrix(planning_type):
@@ -26,46 +28,59 @@ def open_routes_url_matrix(planning_type):
     raise ValueError("Type not supported " + planning_type)
 
 
-def request_dist_matrix(adresses_json, api_key, planning_type):
-    # return request_local(adresses_json)
-    return request_dist_remote(adresses_json, api_key, planning_type)
+@lru_cache(maxsize=None)
+def matrix_fetcher(api_key, planning_type):
+    """One fetcher per process, api key and planning type, its connections and Retry-After pauses outlive a call."""
+    return TiledMatrixFetcher(OrsEndpoint(open_routes_url_matrix(planning_type), api_key))
+
 
+@lru_cache(maxsize=1)
+def local_matrix_fetcher():
+    return TiledMatrixFetcher(OsrmEndpoint(DISTANCE_MATRIX_QUERY))
 
-def request_dist_remote(adresses_json, api_key, planning_type):
-    data = json.dumps(
-        {"locations": [[item['lon'], item['lat']] for item in adresses_json], "metrics": ["duration"]})
+
+def request_dist_matrix(adresses_json, api_key, planning_type, cache=None):
+    fetcher = matrix_fetcher(api_key, planning_type)
     print("POST DIST_MATRIX " + api_key)
-    response = requests.post(open_routes_url_matrix(planning_type), data=data, headers=(header(api_key)), timeout=10)
-    print(response)
+    if cache:
+        return {'durations': cache.get_or_fetch(adresses_json, planning_type, fetcher.fetch)}
+    return {'durations': fetcher.fetch(adresses_json).tolist()}
+
+
+def request_coordinates_remote(api_key, code, address, country, locality, session=requests):
+    response = session.get(OPEN_ROUTES_URL_COORDINATES2,
+                           params={'api_key': api_key, 'text': code + ' ' + address + ' ' + locality,
+                                   'country': country, 'layers': 'address', 'size': 1}, timeout=10)
     if response.status_code == 200:
         return response.json()
 
     raise ConnectionError(response.status_code)
 
 
-def request_coordinates_remote(api_key, code, address, country, locality):
-    response = requests.get(OPEN_ROUTES_URL_COORDINATES2,
-                            params={'api_key': api_key, 'text': code + ' ' + address + ' ' + locality,
-                                    'country': country, 'layers': 'address', 'size': 1})
-    if response.status_code == 200:
-        return response.json()
+def first_coordinates(response_json):
+    features_ = response_json['features']
+    if len(features_) <= 0:
+        return None
+    coords_result = features_[0]['geometry']['coordinates']
+    return {'lat': coords_result[1], 'lon': coords_result[0]}
+
+
+def structured_address_key(address):
+    return '|'.join(str(address.get(key, '')).strip().lower() for key in ['code', 'address', 'country', 'locality'])
 
-    raise ConnectionError(response.status_code)
 
+def make_coordinates_geocoder(api_key, cache, rate=GEOCODE_RATE, max_workers=4):
+    """Geocoder resolving structured addresses (code, address, country, locality) with openrouteservice."""
 
-def header(api_key):
-    headers = {"Authorization": "Bearer " + api_key, 'Accept-Encoding': 'UTF-8', 'Content-Type': 'application/json',
-               'Accept': '*/*'}
-    return headers
+    def lookup(session, address):
+        return first_coordinates(request_coordinates_remote(api_key, address['code'], address['address'],
+                                                            address['country'], address['locality'], session))
+
+    return Geocoder(lookup, structured_address_key, cache, max_workers=max_workers, rate=rate)
 
 
 def request_local(adresses_json):
-    url = make_url(adresses_json)
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise ConnectionError("Bad request " + str(response.status_code))
+    return {'durations': local_matrix_fetcher().fetch(adresses_json).tolist()}
 
 
 def make_url(addresses):
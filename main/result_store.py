@@ -0,0 +1,96 @@
+"""Compact storage of job results and of the GET /vrp response of completed jobs."""
+import gzip
+import hashlib
+import json
+import zlib
+
+RESULT_TTL = 5000
+
+
+def result_key(job_id):
+    return 'vrp:result:' + job_id
+
+
+def encode_routes(routes):
+    """Routes of address dicts as routes of indices into a table holding every address once."""
+    table, position = [], {}
+    encoded = []
+    for route in routes:
+        indices = []
+        for address in route:
+            key = json.dumps(address, sort_keys=True)
+            if key not in position:
+                position[key] = len(table)
+                table.append(address)
+            indices.append(position[key])
+        encoded.append(indices)
+    return {'addresses': table, 'routes': encoded}
+
+
+def decode_routes(encoded):
+    return [[encoded['addresses'][idx] for idx in route] for route in encoded['routes']]
+
+
+def flatten_routes(routes):
+    """All stops in one list, each address with the index of its route as idx."""
+    return [dict(address, idx=idx) for idx, route in enumerate(routes) for address in route]
+
+
+def store_result(connection, job_id, meta, routes, ttl=RESULT_TTL):
+    """
+    Keeps the encoded routes and the complete, gzipped GET /vrp response of the job with its ETag, so polls of a
+    completed job are answered without loading or flattening the result again.
+    """
+    response = {'id': job_id, 'status': 'completed', 'result': {'routes': flatten_routes(routes)}}
+    response.update(meta)
+    body = json.dumps(response).encode()
+    key = result_key(job_id)
+    pipeline = connection.pipeline()
+    pipeline.hset(key, mapping={
+        'routes': zlib.compress(json.dumps(encode_routes(routes)).encode()),
+        'body': gzip.compress(body),
+        'etag': hashlib.sha1(body).hexdigest(),
+    })
+    pipeline.expire(key, ttl)
+    pipeline.execute()
+
+
+def load_routes(connection, job_id):
+    """The routes of address dicts of a completed job, None if there is no stored result."""
+    data = connection.hget(result_key(job_id), 'routes')
+    return decode_routes(json.loads(zlib.decompress(data))) if data else None
+
+
+def load_etag(connection, job_id):
+    etag = connection.hget(result_key(job_id), 'etag')
+    return etag.decode() if etag else None
+
+
+def load_response_body(connection, job_id):
+    """The gzipped GET /vrp response of a completed job."""
+    return connection.hget(result_key(job_id), 'body')
+
+
+def update_result_meta(connection, job_id, meta):
+    """Stores the GET /vrp response of a completed job again with its current meta, keeping the expiry."""
+    routes = load_routes(connection, job_id)
+    if routes is not None:
+        ttl = connection.ttl(result_key(job_id))
+        store_result(connection, job_id, meta, routes, ttl if ttl > 0 else RESULT_TTL)
+
+
+def load_export(connection, job_id, name, build):
+    """
+    The export name of a completed job as str. It is built by build from the routes on first use and kept in the
+    result hash, so it expires with the result. None if there is no stored result.
+    """
+    key = result_key(job_id)
+    data = connection.hget(key, 'export:' + name)
+    if data:
+        return zlib.decompress(data).decode()
+    routes = load_routes(connection, job_id)
+    if routes is None:
+        return None
+    export = build(routes)
+    connection.hset(key, 'export:' + name, zlib.compress(export.encode()))
+    return export
@@ -5,62 +5,244 @@ from __future__ import print_function
 import json
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
 
+import numpy as np
 from ortools.constraint_solver import pywrapcp
 from ortools.constraint_solver import routing_enums_pb2
 
-from main.constants import DIST_MATRIX_FILE, ADDRESS_CSV
+from main.constants import DIST_MATRIX_BINARY_FILE, ADDRESS_CSV, MAX_TIME_DURATION
 from main.cmd.csv_processing import make_formatted_routes
+from main.contraction import contract
+from main.decompose import use_decomposition, solve_decomposed
+from main.matrix_file import open_matrix, durations_array
+from main.presolve import presolve, InfeasibleConstraints
+from main.progress import SolutionReporter, ExpandingProgress, RelayedProgress, relay_progress
+from main.solution import DEBUG_SOLUTION, extract_routes, route_kpis, route_totals
+from main.telemetry import timed
 from main.template import render
 from main.util import resolve_address_file, print_solution, json_file_name_from_csv, check
+from main.warm_start import repair_routes
 
-MAX_TIME_DURATION = 60 * 60 * 360 * 1000
+TRANSIT_NATIVE = 'native'
+TRANSIT_PYTHON = 'python'
+
+DEFAULT_PARALLEL_WORKERS = int(os.getenv('SOLVER_WORKERS', 1))
+
+LOG_SEARCH = os.getenv('SOLVER_LOG_SEARCH', '') == '1'  # the search log floods stdout, statistics hold the numbers
+
+# (first solution strategy, local search metaheuristic, guided local search lambda), in the order they are used
+PORTFOLIO = [
+    ('PATH_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH', 0.25),
+    ('LOCAL_CHEAPEST_INSERTION', 'GUIDED_LOCAL_SEARCH', 0.25),
+    ('LOCAL_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH', 0.25),
+    ('GLOBAL_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH', 0.25),
+    ('PATH_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH', 0.1),
+    ('PARALLEL_CHEAPEST_INSERTION', 'GUIDED_LOCAL_SEARCH', 0.5),
+    ('PATH_CHEAPEST_ARC', 'SIMULATED_ANNEALING', 0.25),
+    ('SAVINGS', 'TABU_SEARCH', 0.25),
+]
 
 
 def create_data_model(dist_matrix, json_constraints):
     """Stores the data for the problem."""
     time = time_matrix(dist_matrix, json_constraints['fixed_arcs'])
-    depot_idx = json_constraints['depot']
-    default_dwell_duration = json_constraints['dwell_duration'][-1]
-    for i in range(0, len(time)):
-        for j in range(0, len(time[i])):
-            time[i][j] += default_dwell_duration if i != depot_idx and j != depot_idx else 0
-
-    dwell_duration = json_constraints['dwell_duration']
-    for idx, duration in dwell_duration.items():
-        for idx2, item in enumerate(time[idx]):
-            time[idx][idx2] += (duration - default_dwell_duration) if idx != -1 else 0
+    add_dwell_durations(time, json_constraints['dwell_duration'], json_constraints['depot'])
     result = {'time_matrix': time}
     result.update(json_constraints)
     return result
 
 
 def time_matrix(dist_matrix, fixed_arcs):
-    durations = dist_matrix['durations']
+    """Returns the durations as a new int64 array, where every arc leaving a node of a fixed arc is blocked except
+    the one to its successor. Missing durations (unreachable pairs) are blocked as well."""
+    durations = durations_array(dist_matrix)
+    if np.issubdtype(durations.dtype, np.integer):
+        # integer durations have no missing ones, they are copied once, straight to int64
+        durations = durations.astype(np.int64)
+    else:
+        durations = np.where(np.isnan(durations), MAX_TIME_DURATION, np.rint(durations)).astype(np.int64)
 
-    for fixed_arc in fixed_arcs:
-        for i in range(0, len(fixed_arc) - 1):
-            durations_to_nodes_for_i = durations[fixed_arc[i]]
-            for to_node_idx in range(0, len(durations_to_nodes_for_i)):
-                if to_node_idx != fixed_arc[i + 1]:
-                    durations_to_nodes_for_i[to_node_idx] = MAX_TIME_DURATION
-            durations[fixed_arc[i]] = durations_to_nodes_for_i
+    steps = [(fixed_arc[i], fixed_arc[i + 1]) for fixed_arc in fixed_arcs for i in range(0, len(fixed_arc) - 1)]
+    if steps:
+        sources, targets = np.array(steps, dtype=np.intp).T
+        # A column stays open only if every fixed arc leaving that row points to it.
+        row_hits = np.bincount(sources, minlength=len(durations))
+        pair_hits = np.zeros(durations.shape, dtype=np.int32)
+        np.add.at(pair_hits, (sources, targets), 1)
+        durations[row_hits[:, None] > pair_hits] = MAX_TIME_DURATION
 
     return durations
 
 
-def solve(dist_matrix, json_constraints):
+def add_dwell_durations(time, dwell_duration, depot_idx):
+    """Adds the default dwell duration to every arc not touching the depot and the per-node deviation from it to all
+    arcs leaving that node."""
+    dwell_duration = dict((int(idx), int(duration)) for idx, duration in dwell_duration.items())
+    default_dwell_duration = dwell_duration[-1]
+
+    not_depot = np.ones(len(time), dtype=bool)
+    not_depot[depot_idx] = False
+    time[np.ix_(not_depot, not_depot)] += default_dwell_duration
+
+    nodes = [idx for idx in dwell_duration.keys() if idx != -1]
+    if nodes:
+        extra = np.array([dwell_duration[idx] - default_dwell_duration for idx in nodes], dtype=np.int64)
+        np.add.at(time, np.array(nodes, dtype=np.intp), extra[:, None])
+    return time
+
+
+def solve(dist_matrix, json_constraints, statistics=None, progress=None):
+    """Solves the instance on its Contraction unless the constraints set contract to false, uncontracted if the
+    constraints of the contraction cannot be met."""
+    statistics = {} if statistics is None else statistics
+    with timed(statistics.setdefault('phases', {}), 'contraction'):
+        contraction = contract(dist_matrix, json_constraints) if json_constraints.get('contract', True) else None
+    if contraction is None:
+        return solve_model(dist_matrix, json_constraints, statistics, progress)
+
+    statistics['contraction'] = {'nodes': len(contraction.super_node), 'super_nodes': len(contraction.groups),
+                                 'contracted_chains': len(contraction.chains)}
+    print("Contraction: ", statistics['contraction'])
+    try:
+        routes = solve_model(contraction.dist_matrix, contraction.constraints, statistics,
+                             ExpandingProgress(progress, contraction) if progress else None)
+    except InfeasibleConstraints as e:
+        # solved uncontracted, which either finds routes or raises InfeasibleConstraints naming the original stops
+        print("Contraction infeasible, solving uncontracted: ", e.reasons)
+        statistics['contraction']['infeasible'] = e.reasons
+        return solve_model(dist_matrix, json_constraints, statistics, progress)
+    return contraction.expand(routes)
+
+
+def solve_model(dist_matrix, json_constraints, statistics, progress=None):
     print("---->Solve")
-    depot_idx = json_constraints['depot']
 
     """Solve the CVRP problem."""
+    phases = statistics.setdefault('phases', {})
     # Instantiate the data problem.
-    data = create_data_model(dist_matrix, json_constraints)
+    with timed(phases, 'create_data_model'):
+        data = create_data_model(dist_matrix, json_constraints)
+    with timed(phases, 'presolve'):
+        data.update(presolve(data))
+    workers = parallel_workers(data)
+    if workers > 1:
+        with timed(phases, 'search'):
+            return solve_portfolio(data, workers, statistics, progress)
+
+    with timed(phases, 'build_model'):
+        manager, routing, time_dimension = build_model(data)
+        reporter = SolutionReporter(manager, routing, progress).attach()
+
+    search_parameters = set_search_parameters(data['timeout'],
+                                              data.get('first_solution_strategy', 'PATH_CHEAPEST_ARC'))
+
+    # Solve the problem.
+    print("Start Solving")
+    with timed(phases, 'search'):
+        solution = run_search(data, manager, routing, search_parameters, statistics)
+    statistics['objective'] = solution.ObjectiveValue() if solution else None
+    statistics['first_solution_seconds'] = reporter.first_solution_elapsed
+    statistics['improvements'] = reporter.improvements
+    if progress:
+        reporter.publish()
+        statistics['stopped_early'] = reporter.stopped
+
+    print("Solver status: ", routing.status())
+    statistics['search'] = search_statistics(routing)
+    print("Search statistics: ", statistics['search'])
+
+    if solution:
+        with timed(phases, 'extract_solution'):
+            if DEBUG_SOLUTION:
+                print_solution(data, manager, routing, solution, time_dimension)
+            return extract_routes(manager, routing, solution)
+    else:
+        return []
+
+
+def parallel_workers(data):
+    requested = int(data.get('parallel_workers', DEFAULT_PARALLEL_WORKERS))
+    return max(1, min(requested, len(PORTFOLIO), os.cpu_count() or 1))
+
+
+def solve_portfolio(data, workers, statistics, progress=None):
+    """Runs the first strategies of the PORTFOLIO in parallel processes for the same timeout and returns the routes of
+    the cheapest solution. The cost per strategy is recorded in statistics['portfolio'], the solver statistics of the
+    cheapest one like those of a single search. Improving solutions of all strategies are published to progress."""
+    strategies = PORTFOLIO[:workers]
+    print("Start Solving with " + str(workers) + " strategies")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if progress:
+            with Manager() as manager:
+                queue, stop_event = manager.Queue(), manager.Event()
+                futures = [executor.submit(solve_with_strategy, data, strategy,
+                                           RelayedProgress(queue, stop_event, '/'.join(map(str, strategy))))
+                           for strategy in strategies]
+                relay_progress(futures, queue, stop_event, progress)
+                statistics['stopped_early'] = stop_event.is_set()
+                results = [future.result() for future in futures]
+        else:
+            results = list(executor.map(solve_with_strategy, [data] * len(strategies), strategies))
+
+    statistics['portfolio'] = [dict((key, result[key]) for key in ['strategy', 'cost', 'search', 'warm_start'])
+                               for result in results]
+    first_solutions = [result['first_solution_seconds'] for result in results
+                       if result['first_solution_seconds'] is not None]
+    statistics['first_solution_seconds'] = min(first_solutions) if first_solutions else None
+    solved = [result for result in results if result['cost'] is not None]
+    if not solved:
+        return []
+    best = min(solved, key=lambda result: result['cost'])
+    statistics['best_strategy'] = best['strategy']
+    statistics['objective'] = best['cost']
+    statistics['improvements'] = best['improvements']
+    statistics['search'] = best['search']
+    print("Best strategy: ", best['strategy'], best['cost'])
+    return best['routes']
+
+
+def solve_with_strategy(data, strategy, progress=None):
+    manager, routing, _ = build_model(data)
+    reporter = SolutionReporter(manager, routing, progress).attach()
+    search_parameters = set_search_parameters(data['timeout'], *strategy)
+    search_parameters.log_search = False
+    statistics = {}
+    solution = run_search(data, manager, routing, search_parameters, statistics)
+    if progress:
+        reporter.publish()
+    result = {'strategy': '/'.join(str(item) for item in strategy), 'cost': None, 'routes': [],
+              'search': search_statistics(routing), 'warm_start': statistics.get('warm_start'),
+              'first_solution_seconds': reporter.first_solution_elapsed, 'improvements': reporter.improvements}
+    if solution:
+        result['cost'] = solution.ObjectiveValue()
+        result['routes'] = extract_routes(manager, routing, solution)
+    return result
+
+
+def run_search(data, manager, routing, search_parameters, statistics):
+    """Solves from the repaired initial_routes of data if there are any the model accepts, from scratch otherwise."""
+    if not data.get('initial_routes'):
+        return routing.SolveWithParameters(search_parameters)
+
+    routes, reinserted = repair_routes(data['initial_routes'], data)
+    routing.CloseModelWithParameters(search_parameters)
+    initial_assignment = routing.ReadAssignmentFromRoutes(
+        [[manager.NodeToIndex(node) for node in route] for route in routes], True)
+    statistics['warm_start'] = {'used': initial_assignment is not None, 'reinserted_nodes': reinserted}
+    print("Warm start: ", statistics['warm_start'])
+    if initial_assignment is None:
+        return routing.SolveWithParameters(search_parameters)
+    return routing.SolveFromAssignmentWithParameters(initial_assignment, search_parameters)
+
+
+def build_model(data):
+    """Creates index manager, routing model and time dimension for the data of create_data_model."""
+    depot_idx = data['depot']
     no_visits = len(data['time_matrix'])
 
-    greatest_dist = max([max(e) for e in data['time_matrix']])
-    greatest_dwell_time = max(data['dwell_duration'].values())
-    ub_tour = int((greatest_dist + greatest_dwell_time) * no_visits + 1) + 1
+    ub_tour = data['horizon']
     mult_num_visits, mult_max_tour_len = data['num_visits_to_max_tour_len_ration']
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(no_visits,
@@ -70,14 +252,8 @@ def solve(dist_matrix, json_constraints):
     routing = pywrapcp.RoutingModel(manager)
 
     # Create and register a transit callback.
-    def time_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['time_matrix'][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
+    transit_mode = data.get('transit', TRANSIT_NATIVE)
+    transit_callback_index = register_time_transit(data['time_matrix'], manager, routing, transit_mode)
 
     # Define cost of each arc.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
@@ -88,7 +264,7 @@ def solve(dist_matrix, json_constraints):
     routing.AddDimension(
         transit_callback_index,
         60 * 60 if time_windows_exist else 0,  # no slack
-        ub_tour,  # 1608
+        ub_tour,
         not time_windows_exist,  # start cumul to zero
         dimension_name)
     time_dimension = routing.GetDimensionOrDie(dimension_name)
@@ -99,12 +275,9 @@ def solve(dist_matrix, json_constraints):
 
     ####### Dwell-Duration
     dimension_num_visits = 'NUM_VISITS'
-    routing.AddDimension(
-        routing.RegisterUnaryTransitCallback(lambda from_node: 1),
-        0,  # null capacity slack
-        (no_visits + 1),  # vehicle maximum capacities
-        True,  # start cumul to zero
-        dimension_num_visits)
+    visits = data.get('visits')
+    add_num_visits_dimension(routing, (sum(visits) if visits else no_visits) + 1, dimension_num_visits,
+                             transit_mode, manager, visits)
 
     capacity_dimension = routing.GetDimensionOrDie(dimension_num_visits)
     capacity_dimension.SetGlobalSpanCostCoefficient(100 * mult_num_visits)
@@ -114,26 +287,74 @@ def solve(dist_matrix, json_constraints):
     # for node in range(1, len(data['time_matrix'])):
     #   routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
 
-    add_assign_to_route_constraints(data['assign_to_route'], manager, routing)
+    add_allowed_vehicles(data['allowed_vehicles'], manager, routing)
     add_same_route_constraints(data['same_route'], manager, routing)
     add_same_route_constraints(data['same_route_ordered'], manager, routing, time_dimension)
     add_different_route_constraints(data, manager, routing)
 
-    search_parameters = set_search_parameters(data['timeout'])
-
-    # Solve the problem.
-    # initial_assignment = routing.ReadAssignmentFromRoutes(INITIAL_SOLUTION, True)
-    # solution = routing.SolveFromAssignmentWithParameters(initial_assignment, search_parameters)
-    print("Start Solving")
-    solution = routing.SolveWithParameters(search_parameters)
+    return manager, routing, time_dimension
+
+
+def register_time_transit(time, manager, routing, transit_mode=TRANSIT_NATIVE):
+    """Registers the time matrix as transit evaluator and returns its index.
+
+    In native mode the matrix is handed to the solver, so evaluating an arc never calls back into Python. Solver
+    versions without RegisterTransitMatrix get a callback on a matrix already permuted into routing index space."""
+    if transit_mode == TRANSIT_PYTHON:
+        time_matrix_rows = time.tolist()
+
+        def time_callback(from_index, to_index):
+            """Returns the distance between the two nodes."""
+            # Convert from routing variable Index to distance matrix NodeIndex.
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            return time_matrix_rows[from_node][to_node]
+
+        return routing.RegisterTransitCallback(time_callback)
+
+    if transit_mode != TRANSIT_NATIVE:
+        raise ValueError('Transit mode unsupported ' + str(transit_mode))
+
+    if hasattr(routing, 'RegisterTransitMatrix'):
+        return routing.RegisterTransitMatrix(time.tolist())
+
+    index_to_node = [manager.IndexToNode(index) for index in range(routing.Size() + routing.vehicles())]
+    index_rows = time[np.ix_(index_to_node, index_to_node)].tolist()
+    return routing.RegisterTransitCallback(lambda from_index, to_index: index_rows[from_index][to_index])
+
+
+def add_num_visits_dimension(routing, capacity, dimension_name, transit_mode=TRANSIT_NATIVE, manager=None,
+                             visits=None):
+    """Adds a dimension counting one per visited node, or visits[node] if given, e.g. for contracted nodes."""
+    if visits is not None:
+        if transit_mode == TRANSIT_NATIVE and hasattr(routing, 'RegisterUnaryTransitVector'):
+            transit_index = routing.RegisterUnaryTransitVector(list(visits))
+        else:
+            transit_index = routing.RegisterUnaryTransitCallback(
+                lambda from_index: visits[manager.IndexToNode(from_index)])
+        routing.AddDimension(transit_index, 0, capacity, True, dimension_name)
+    elif transit_mode == TRANSIT_PYTHON:
+        routing.AddDimension(
+            routing.RegisterUnaryTransitCallback(lambda from_node: 1),
+            0,  # null capacity slack
+            capacity,  # vehicle maximum capacities
+            True,  # start cumul to zero
+            dimension_name)
+    else:
+        routing.AddConstantDimension(1, capacity, True, dimension_name)
 
-    print("Solver status: ", routing.status())
 
-    # Print solution on console.
-    if solution:
-        return print_solution(data, manager, routing, solution, routing.GetDimensionOrDie(dimension_name))
-    else:
-        return []
+def search_statistics(routing):
+    """Returns counters of the last search, branches per second serving as measure for search iterations."""
+    solver = routing.solver()
+    wall_time_ms = solver.WallTime()
+    return {
+        'wall_time_ms': wall_time_ms,
+        'branches': solver.Branches(),
+        'failures': solver.Failures(),
+        'solutions': solver.Solutions(),
+        'branches_per_second': int(solver.Branches() * 1000 / wall_time_ms) if wall_time_ms else 0
+    }
 
 
 def add_time_windows(data, manager, routing, time_dimension):
@@ -157,15 +378,15 @@ def add_time_windows(data, manager, routing, time_dimension):
             time_dimension.CumulVar(routing.End(i)))
 
 
-def add_assign_to_route_constraints(route_assignments, manager, routing):
-    n2x = manager.NodeToIndex
-    cpsolver = routing.solver()
-
-    for route_idx, route_assignment in enumerate(route_assignments):
-        for stop in route_assignment:
-            vehicle_var = routing.VehicleVar(n2x(stop))
-            values = [-1, route_idx]
-            cpsolver.Add(cpsolver.MemberCt(vehicle_var, values))
+def add_allowed_vehicles(allowed_vehicles, manager, routing):
+    """Restricts the stops to the vehicle domains of the presolve, which cover assign_to_route."""
+    for node, vehicles in allowed_vehicles.items():
+        index = manager.NodeToIndex(node)
+        try:
+            routing.SetAllowedVehiclesForIndex(vehicles, index)
+        except TypeError:
+            # the python wrapper of some solver versions cannot convert the vehicle list
+            routing.VehicleVar(index).SetValues([-1] + vehicles)
 
 
 def add_same_route_constraints(same_routes, manager, routing, time_dimension=None):
@@ -191,17 +412,18 @@ def add_different_route_constraints(data, manager, routing):
         cpsolver.Add(cpsolver.AllDifferent([vehicle_var_1, vehicle_var_2]))
 
 
-def set_search_parameters(time_out):
+def set_search_parameters(time_out, first_solution_strategy='PATH_CHEAPEST_ARC',
+                          local_search_metaheuristic='GUIDED_LOCAL_SEARCH', gls_lambda=0.25):
     # Setting first solution heuristic.
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+        getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy))
     # PATH_CHEAPEST_ARC 7640 PATH_CHEAPEST_ARC 7533  LOCAL_CHEAPEST_INSERTION 7613
     # GLOBAL_CHEAPEST_ARC 7591 LOCAL_CHEAPEST_ARC 7587
     search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+        getattr(routing_enums_pb2.LocalSearchMetaheuristic, local_search_metaheuristic))
     search_parameters.time_limit.seconds = time_out
-    search_parameters.log_search = True
+    search_parameters.log_search = LOG_SEARCH
     # search_parameters.use_depth_first_search = True
     search_parameters.use_full_propagation = 3
     # search_parameters.use_cp_sat = 3
@@ -228,13 +450,27 @@ def set_search_parameters(time_out):
     # use_light_relocate_pair: BOOL_TRUE
     # use_relocate_subtrip: BOOL_TRUE
     # use_exchange_subtrip: BOOL_TRUE
-    search_parameters.guided_local_search_lambda_coefficient = 0.25
+    search_parameters.guided_local_search_lambda_coefficient = gls_lambda
     # search_parameters.lns_time_limit.seconds = 100
     return search_parameters
 
 
-def mainrunner(matrix_file, json_constraints, json_addresses):
-    routes = solve(matrix_file, json_constraints)
+def mainrunner(matrix_file, json_constraints, json_addresses, statistics=None, progress=None):
+    """Solves the instance and returns the routes of addresses, the KPIs of the routes go to statistics['routes']."""
+    statistics = {} if statistics is None else statistics
+    if use_decomposition(json_constraints, len(json_addresses)):
+        routes = solve_decomposed(matrix_file, json_constraints, json_addresses, solve, statistics, progress)
+    else:
+        routes = solve(matrix_file, json_constraints, statistics, progress)
+    return format_routes(matrix_file, json_constraints, json_addresses, routes, statistics)
+
+
+def format_routes(matrix_file, json_constraints, json_addresses, routes, statistics):
+    """The routes of node indices as routes of addresses, their KPIs go to statistics['routes']."""
+    with timed(statistics.setdefault('phases', {}), 'route_kpis'):
+        statistics['routes'] = route_kpis(matrix_file, json_constraints, routes)
+        statistics['route_totals'] = route_totals(statistics['routes'])
+    print("Routes: ", statistics['route_totals'])
     return make_formatted_routes(routes, json_addresses)
 
 
@@ -245,9 +481,8 @@ def main():
         json_addresses = json.load(adress_file)
     with open(constraints_file) as constraints_file_handle:
         json_constraints = json.load(constraints_file_handle)
-    dist_matrix_file = str(sys.argv[3])
-    with open(dist_matrix_file) as dist_matrix_file:
-        dist_matrix = json.load(dist_matrix_file)
+    dist_matrix_file = str(sys.argv[3]) if len(sys.argv) > 3 else DIST_MATRIX_BINARY_FILE
+    dist_matrix = open_matrix(dist_matrix_file, json_addresses, json_constraints.get('planningType', 'foot'))
 
     check(json_constraints, json_addresses)
 
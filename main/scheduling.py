@@ -0,0 +1,113 @@
+"""Routing of solver jobs to queues by size, per recipient limits and queue wait estimates."""
+import hashlib
+import math
+import os
+
+from rq import Queue, Retry, Worker
+from rq.job import Job
+from rq.registry import StartedJobRegistry
+
+QUICK_QUEUE = 'vrp-quick'
+STANDARD_QUEUE = 'vrp-standard'
+BULK_QUEUE = 'vrp-bulk'
+DEFAULT_QUEUE = 'default'  # geocoding jobs
+MAIL_QUEUE = 'vrp-mail'  # served by main.worker.mail_worker only
+RUN_MAIL_JOB = 'main.worker.mail_job.run_mail_job'
+RUN_ERROR_MAIL_JOB = 'main.worker.mail_job.run_error_mail_job'
+SOLVER_QUEUES = [QUICK_QUEUE, STANDARD_QUEUE, BULK_QUEUE]
+
+QUICK_MAX_NODES = int(os.getenv('QUICK_MAX_NODES', 60))
+QUICK_MAX_TIMEOUT = int(os.getenv('QUICK_MAX_TIMEOUT', 60))
+BULK_MIN_NODES = int(os.getenv('BULK_MIN_NODES', 400))
+BULK_MIN_TIMEOUT = int(os.getenv('BULK_MIN_TIMEOUT', 300))
+MAX_ACTIVE_JOBS_PER_RECIPIENT = int(os.getenv('MAX_ACTIVE_JOBS_PER_RECIPIENT', 2))
+ACTIVE_JOBS_TTL = 24 * 60 * 60
+RECENT_DURATIONS = 50
+MAIL_RETRY_INTERVALS = [int(seconds) for seconds in os.getenv('MAIL_RETRY_INTERVALS', '30,120,600').split(',')]
+MAIL_RESULT_TTL = 24 * 60 * 60
+ACTIVE_STATUSES = ['queued', 'started', 'deferred', 'scheduled']
+
+
+def queue_name(no_nodes, timeout):
+    """Previews go to the quick queue, whole town solves with many nodes or a long timeout to the bulk queue."""
+    if no_nodes <= QUICK_MAX_NODES and timeout <= QUICK_MAX_TIMEOUT:
+        return QUICK_QUEUE
+    if no_nodes >= BULK_MIN_NODES or timeout >= BULK_MIN_TIMEOUT:
+        return BULK_QUEUE
+    return STANDARD_QUEUE
+
+
+def worker_queue_layout(concurrency):
+    """
+    The queues of each of concurrency workers, in priority order. A quarter of the workers only take quick jobs and
+    at most a quarter take bulk jobs, so neither waits for the other. With less than three workers all of them take
+    every queue, quick jobs first.
+    """
+    every_queue = [QUICK_QUEUE, STANDARD_QUEUE, BULK_QUEUE, DEFAULT_QUEUE]
+    if concurrency < 3:
+        return [every_queue] * concurrency
+    quick_workers = bulk_workers = max(1, concurrency // 4)
+    standard_workers = concurrency - quick_workers - bulk_workers
+    return ([[QUICK_QUEUE, DEFAULT_QUEUE]] * quick_workers +
+            [[BULK_QUEUE, STANDARD_QUEUE, QUICK_QUEUE, DEFAULT_QUEUE]] * bulk_workers +
+            [[STANDARD_QUEUE, QUICK_QUEUE, DEFAULT_QUEUE]] * standard_workers)
+
+
+def active_jobs_key(recipient):
+    return 'vrp:active:' + hashlib.sha1(recipient.lower().encode()).hexdigest()
+
+
+def active_job_ids(connection, recipient):
+    """The ids of the queued or running jobs of recipient, forgetting those that ended or expired."""
+    key = active_jobs_key(recipient)
+    job_ids = [job_id.decode() for job_id in connection.smembers(key)]
+    jobs = Job.fetch_many(job_ids, connection=connection)
+    ended = [job_id for job_id, job in zip(job_ids, jobs) if job is None or job.get_status() not in ACTIVE_STATUSES]
+    if ended:
+        connection.srem(key, *ended)
+    return [job_id for job_id in job_ids if job_id not in ended]
+
+
+def add_active_job(connection, recipient, job_id):
+    key = active_jobs_key(recipient)
+    pipeline = connection.pipeline()
+    pipeline.sadd(key, job_id)
+    pipeline.expire(key, ACTIVE_JOBS_TTL)
+    pipeline.execute()
+
+
+def durations_key(queue):
+    return 'vrp:durations:' + queue
+
+
+def record_duration(connection, queue, seconds):
+    """Keeps the run time of a job among the RECENT_DURATIONS ones of its queue the wait is estimated from."""
+    pipeline = connection.pipeline()
+    pipeline.lpush(durations_key(queue), round(seconds, 3))
+    pipeline.ltrim(durations_key(queue), 0, RECENT_DURATIONS - 1)
+    pipeline.execute()
+
+
+def estimated_wait(connection, job):
+    """
+    Seconds until the queued job starts: the jobs ahead of it in its queue and the running ones, each taking the
+    mean of the recent run times of the queue, spread over the workers of the queue. None without recent jobs or
+    when the job is not queued.
+    """
+    durations = [float(seconds) for seconds in connection.lrange(durations_key(job.origin), 0, -1)]
+    queue = Queue(job.origin, connection=connection)
+    job_ids = queue.job_ids
+    if not durations or job.id not in job_ids:
+        return None
+    position = job_ids.index(job.id)
+    workers = max(1, Worker.count(connection=connection, queue=queue))
+    running = StartedJobRegistry(job.origin, connection=connection).count
+    jobs_before_start = max(0, position + running - workers + 1)
+    return round(math.ceil(jobs_before_start / workers) * sum(durations) / len(durations), 1)
+
+
+def enqueue_mail(connection, func, args, depends_on=None):
+    """Enqueues the mail job func on the mail queue, retried after each of MAIL_RETRY_INTERVALS when it fails."""
+    return Queue(MAIL_QUEUE, connection=connection).enqueue_call(
+        func=func, args=args, depends_on=depends_on, result_ttl=MAIL_RESULT_TTL, failure_ttl=MAIL_RESULT_TTL,
+        retry=Retry(max=len(MAIL_RETRY_INTERVALS), interval=MAIL_RETRY_INTERVALS))
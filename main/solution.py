@@ -0,0 +1,98 @@
+"""Bulk extraction of the routes of a solution and their KPIs, computed with NumPy from the durations."""
+import os
+
+import numpy as np
+
+# prints every route with its time windows like print_solution, the KPIs in the statistics hold the numbers
+DEBUG_SOLUTION = os.getenv('SOLVER_DEBUG_SOLUTION', '') == '1'
+
+
+def extract_routes(manager, routing, solution):
+    """The routes of node indices of the solution, reading every next variable once and walking plain lists."""
+    size = routing.Size()
+    next_index = [solution.Value(routing.NextVar(index)) for index in range(size)]
+    index_to_node = [manager.IndexToNode(index) for index in range(size + routing.vehicles())]
+    routes = []
+    for vehicle_id in range(routing.vehicles()):
+        index = routing.Start(vehicle_id)
+        route = [index_to_node[index]]
+        while index < size:
+            index = next_index[index]
+            route.append(index_to_node[index])
+        routes.append(route)
+    return routes
+
+
+def route_kpis(dist_matrix, json_constraints, routes):
+    """
+    Per route its duration, walking, dwell and waiting seconds, the number of visits, the arrival times at its nodes
+    and the time window slack of its stops, None for stops without window. Arrivals follow the earliest schedule of
+    the time dimension: a stop is left after its dwell duration, and a stop is not reached before its window opens.
+    """
+    durations = np.nan_to_num(np.asarray(dist_matrix['durations'], dtype=np.float64))
+    no_nodes = len(durations)
+    depot = json_constraints['depot']
+    dwell = dwell_vector(no_nodes, json_constraints['dwell_duration'], depot)
+    opens, closes = window_vectors(no_nodes, json_constraints.get('time_windows') or {})
+    start = opens[depot] if np.isfinite(opens[depot]) else 0
+    return [route_kpi(durations, dwell, opens, closes, start, route) for route in routes]
+
+
+def route_kpi(durations, dwell, opens, closes, start, route):
+    nodes = np.asarray(route, dtype=np.intp)
+    walking = durations[nodes[:-1], nodes[1:]]
+    legs = walking + dwell[nodes[:-1]]
+    arrivals = earliest_arrivals(legs, opens[nodes], start)
+    slack = closes[nodes[1:-1]] - arrivals[1:-1]
+    duration = arrivals[-1] - arrivals[0]
+    return {
+        'duration': int(round(duration)),
+        'walking': int(round(walking.sum())),
+        'dwell': int(round(dwell[nodes].sum())),
+        'waiting': int(round(duration - legs.sum())),
+        'visits': len(route) - 2,
+        'arrivals': np.rint(arrivals).astype(np.int64).tolist(),
+        'time_window_slack': [int(round(value)) if np.isfinite(value) else None for value in slack],
+    }
+
+
+def earliest_arrivals(legs, opens, start):
+    """Arrival times at the nodes of a route with the given leg durations and window openings, leaving at start."""
+    offsets = np.concatenate([[0.0], np.cumsum(legs)])
+    earliest = np.array(opens, dtype=np.float64)
+    earliest[0] = start
+    # waiting for a window shifts all later arrivals: arrival_k = offset_k + max over j <= k of (open_j - offset_j)
+    return offsets + np.maximum.accumulate(earliest - offsets)
+
+
+def route_totals(kpis):
+    durations = [kpi['duration'] for kpi in kpis]
+    slacks = [slack for kpi in kpis for slack in kpi['time_window_slack'] if slack is not None]
+    return {
+        'duration': sum(durations),
+        'max_duration': max(durations) if durations else 0,
+        'walking': sum(kpi['walking'] for kpi in kpis),
+        'dwell': sum(kpi['dwell'] for kpi in kpis),
+        'waiting': sum(kpi['waiting'] for kpi in kpis),
+        'visits': sum(kpi['visits'] for kpi in kpis),
+        'min_time_window_slack': min(slacks) if slacks else None,
+    }
+
+
+def dwell_vector(no_nodes, dwell_duration, depot):
+    """The dwell duration of every node, the default one of key -1 where none is given and 0 at the depot."""
+    dwell_duration = dict((int(idx), int(duration)) for idx, duration in dwell_duration.items())
+    dwell = np.full(no_nodes, dwell_duration[-1], dtype=np.float64)
+    nodes = [idx for idx in dwell_duration if idx != -1]
+    dwell[nodes] = [dwell_duration[idx] for idx in nodes]
+    dwell[depot] = 0
+    return dwell
+
+
+def window_vectors(no_nodes, time_windows):
+    """Opening and closing time of every node, -inf and inf for nodes without window."""
+    opens = np.full(no_nodes, -np.inf)
+    closes = np.full(no_nodes, np.inf)
+    for idx, (window_open, window_close) in time_windows.items():
+        opens[int(idx)], closes[int(idx)] = window_open, window_close
+    return opens, closes
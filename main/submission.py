@@ -0,0 +1,42 @@
+"""Canonical hashing of /vrp submissions, so identical requests share one job."""
+import hashlib
+import json
+import os
+
+from main.result_store import RESULT_TTL
+
+COORDINATE_DECIMALS = 5
+# completed results are reused for this long, the stored result has to outlive it
+REUSE_WINDOW = min(int(os.getenv('VRP_REUSE_WINDOW', 60 * 60)), RESULT_TTL)
+
+
+def instance_key(instance_hash):
+    return 'vrp:instance:' + instance_hash
+
+
+def instance_hash(addresses, json_constraints):
+    """Hash of the addresses, with coordinates rounded to about a meter, and of the constraints, as transformed by
+    create_job; dict key order and int or str keys do not matter."""
+    normalized = {
+        'addresses': [dict(address, lat=round(float(address['lat']), COORDINATE_DECIMALS),
+                           lon=round(float(address['lon']), COORDINATE_DECIMALS)) for address in addresses],
+        'constraints': json_constraints,
+    }
+    return hashlib.sha1(json.dumps(canonical(normalized), sort_keys=True).encode()).hexdigest()
+
+
+def canonical(value):
+    if isinstance(value, dict):
+        return dict((str(key), canonical(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def find_job_id(connection, instance):
+    job_id = connection.get(instance_key(instance))
+    return job_id.decode() if job_id else None
+
+
+def remember_job_id(connection, instance, job_id):
+    connection.set(instance_key(instance), job_id, ex=REUSE_WINDOW)
@@ -0,0 +1,100 @@
+"""Phase timing of jobs and their aggregation into metrics."""
+import json
+import time
+from contextlib import contextmanager
+
+METRICS_KEY = 'vrp:metrics'
+RECENT_KEY = 'vrp:metrics:recent'
+RECENT_JOBS = 500
+QUANTILES = [0.5, 0.9, 0.99]
+
+# job telemetry key -> metric name, exported as summaries over the recent jobs
+SUMMARIES = {
+    'matrix_size': 'vrp_matrix_size',
+    'first_solution_seconds': 'vrp_solver_first_solution_seconds',
+    'branches': 'vrp_solver_branches',
+    'improvements': 'vrp_solver_improvements',
+    'objective': 'vrp_solver_objective',
+}
+
+
+@contextmanager
+def timed(phases, name):
+    """Adds the wall time of the block in seconds to phases[name]."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases[name] = round(phases.get(name, 0) + time.time() - start, 3)
+
+
+def job_telemetry(meta, phases, status):
+    """The numbers of a finished or failed job kept for the metrics, from its meta and phases."""
+    solver = meta.get('solver', {})
+    search = solver.get('search', {})
+    matrix_cache = meta.get('matrix_cache', {})
+    return {
+        'status': status,
+        'phases': phases,
+        'matrix_size': matrix_cache.get('matrix_size'),
+        'matrix_cache': matrix_cache.get('status'),
+        'first_solution_seconds': solver.get('first_solution_seconds'),
+        'branches': search.get('branches'),
+        'improvements': solver.get('improvements'),
+        'objective': solver.get('objective'),
+    }
+
+
+def record_job(connection, telemetry):
+    """Counts the job and keeps its telemetry among the RECENT_JOBS ones the quantiles are computed from."""
+    pipeline = connection.pipeline()
+    pipeline.hincrby(METRICS_KEY, 'jobs:' + telemetry['status'], 1)
+    if telemetry.get('matrix_cache'):
+        pipeline.hincrby(METRICS_KEY, 'matrix_cache:' + telemetry['matrix_cache'], 1)
+    for phase, seconds in telemetry['phases'].items():
+        pipeline.hincrbyfloat(METRICS_KEY, 'phase_sum:' + phase, seconds)
+        pipeline.hincrby(METRICS_KEY, 'phase_count:' + phase, 1)
+    pipeline.lpush(RECENT_KEY, json.dumps(telemetry))
+    pipeline.ltrim(RECENT_KEY, 0, RECENT_JOBS - 1)
+    pipeline.execute()
+
+
+def metrics_text(connection, gauges=None):
+    """Prometheus text exposition of the job counters, the phase times and the solver telemetry of recent jobs."""
+    totals = dict((key.decode(), value.decode()) for key, value in connection.hgetall(METRICS_KEY).items())
+    recent = [json.loads(item) for item in connection.lrange(RECENT_KEY, 0, -1)]
+    lines = []
+
+    lines += ['# TYPE vrp_jobs_total counter']
+    lines += ['vrp_jobs_total{status="%s"} %s' % (key.split(':', 1)[1], value)
+              for key, value in sorted(totals.items()) if key.startswith('jobs:')]
+    lines += ['# TYPE vrp_matrix_cache_lookups_total counter']
+    lines += ['vrp_matrix_cache_lookups_total{status="%s"} %s' % (key.split(':', 1)[1], value)
+              for key, value in sorted(totals.items()) if key.startswith('matrix_cache:')]
+
+    lines += ['# TYPE vrp_phase_seconds summary']
+    phases = sorted(key.split(':', 1)[1] for key in totals if key.startswith('phase_count:'))
+    for phase in phases:
+        values = [job['phases'][phase] for job in recent if phase in job['phases']]
+        lines += summary_lines('vrp_phase_seconds', values, 'phase="%s",' % phase)
+        lines += ['vrp_phase_seconds_sum{phase="%s"} %s' % (phase, round(float(totals['phase_sum:' + phase]), 3)),
+                  'vrp_phase_seconds_count{phase="%s"} %s' % (phase, totals['phase_count:' + phase])]
+
+    for key, name in sorted(SUMMARIES.items()):
+        values = [job[key] for job in recent if job.get(key) is not None]
+        lines += ['# TYPE %s summary' % name]
+        lines += summary_lines(name, values)
+        lines += ['%s_sum %s' % (name, sum(values)), '%s_count %s' % (name, len(values))]
+
+    for name, value in sorted((gauges or {}).items()):
+        lines += ['# TYPE %s gauge' % name, '%s %s' % (name, value)]
+    return '\n'.join(lines) + '\n'
+
+
+def summary_lines(name, values, labels=''):
+    if not values:
+        return []
+    values = sorted(values)
+    return ['%s{%squantile="%s"} %s' % (name, labels, quantile,
+                                        values[min(len(values) - 1, int(quantile * len(values)))])
+            for quantile in QUANTILES]
@@ -1,20 +1,20 @@
 # <iframe src="https://www.google.com/maps/embed?pb=!1m31!1m8!1m3!1d10705.673273926313!2d9.017564647069243!3d48.92799870223893!3m2!1i1024!2i768!4f13.1!4m20!3e2!4m4!2s48.93174%2C9.020655!3m2!1d48.93174!2d9.020655!4m4!2s48.924651%2C9.027033!3m2!1d48.924651!2d9.027033!4m4!2s48.9292215%2C9.0293626!3m2!1d48.9292215!2d9.029362599999999!4m3!3m2!1d48.930242!2d9.031668!5e0!3m2!1sde!2sde!4v1576564363135!5m2!1sde!2sde" width="600" height="450" frameborder="0" style="border:0;" allowfullscreen=""></iframe>
-from functools import reduce
+import os
+from functools import reduce, lru_cache
 
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from main.constants import LINK_URL_TEMPLATE, openstreetmap_url
-from main.util import restrict_to_keys
+
+ADDRESS_LINE_KEYS = ['code', 'city', 'street', 'number', 'name', 'hint']
 
 
 def to_address_line(json_address):
-    address_slices = restrict_to_keys(json_address, ['code', 'city', 'street', 'number', 'name', 'hint']).values()
-    return ' '.join([str(slice) for slice in  address_slices])
+    return ' '.join([str(json_address[key]) for key in ADDRESS_LINE_KEYS])
 
 
 def make_loc(json_address):
-    lat_lons = restrict_to_keys(json_address, ['lat', 'lon'])
-    return 'loc=' + str(lat_lons['lat']) + ',' + str(lat_lons['lon'])
+    return 'loc=' + str(json_address['lat']) + ',' + str(json_address['lon'])
 
 
 def make_center(json_addresses):
@@ -29,13 +29,38 @@ def average_of_key(key, json_addresses, no_entries):
     return avg_lat
 
 
+@lru_cache(maxsize=8)
+def environment(template_dir):
+    """Jinja environment of the directory, compiled templates are kept for the lifetime of the process. Html templates
+    are autoescaped, the addresses are user input."""
+    return Environment(loader=FileSystemLoader(template_dir), autoescape=select_autoescape(['html']),
+                       auto_reload=False, cache_size=-1)
+
+
+def get_template(template_html):
+    template_dir, name = os.path.split(template_html)
+    return environment(template_dir).get_template(name)
+
+
+def route_context(json_addresses, planning_type):
+    return {'addresses': [to_address_line(json_address) for json_address in json_addresses],
+            'map_link': make_map_link(json_addresses, planning_type)}
+
+
 def render(json_addresses, template_html, planning_type):
-    map_link = make_map_link(json_addresses, planning_type)
-    addresses = [to_address_line(json_address) for json_address in json_addresses]
+    return get_template(template_html).render(**route_context(json_addresses, planning_type))
+
+
+def render_routes(json_routes, template_html, planning_type):
+    """The html of every route of a job, rendered with one lookup of the compiled template."""
+    template = get_template(template_html)
+    return [template.render(**route_context(json_route, planning_type)) for json_route in json_routes]
+
 
-    with open(template_html) as file_:
-        template = Template(file_.read())
-    return template.render(addresses=addresses, map_link=map_link)
+def render_combined(json_routes, template_html, planning_type):
+    """All routes of a job in one printable html page."""
+    routes = [route_context(json_route, planning_type) for json_route in json_routes]
+    return get_template(template_html).render(routes=routes)
 
 
 def make_map_link(json_addresses, planning_type):
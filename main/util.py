@@ -5,6 +5,11 @@ def restrict_to_keys(dicto, keys):
     return dict(zip(keys, [dicto[k] for k in keys]))
 
 
+def transform_to_index_value_format(constrains_json, tag):
+    dwell_duration = constrains_json[tag]
+    constrains_json[tag] = dict([item.values() for item in dwell_duration])
+
+
 def json_file_name_from_csv(file_name):
     return file_name.replace('csv', 'json')
 
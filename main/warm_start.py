@@ -0,0 +1,141 @@
+"""Initial routes for the solver from the routes of an earlier job."""
+from collections import defaultdict
+
+import numpy as np
+
+IDENTITY_KEYS = ['code', 'street', 'number', 'name']
+COORDINATE_DECIMALS = 5
+
+
+def address_identity(address):
+    return tuple(str(address.get(key, '')).strip().lower() for key in IDENTITY_KEYS) + \
+           (round(float(address['lat']), COORDINATE_DECIMALS), round(float(address['lon']), COORDINATE_DECIMALS))
+
+
+def remap_routes(previous_routes, addresses, depot):
+    """
+    Translates routes of address dicts, as returned by an earlier job, to node indices of the addresses. Addresses
+    which were removed in the meantime are dropped, as is the depot.
+    """
+    free_nodes = defaultdict(list)
+    for idx, address in enumerate(addresses):
+        free_nodes[address_identity(address)].append(idx)
+
+    routes = []
+    for route in previous_routes:
+        nodes = []
+        for address in route:
+            candidates = free_nodes.get(address_identity(address))
+            if candidates and candidates[0] != depot:
+                nodes.append(candidates.pop(0))
+        routes.append(nodes)
+    return routes
+
+
+def repair_routes(routes, data, feasible=None):
+    """
+    Makes the initial routes fit the number of vehicles and the constraints of data: nodes violating assign_to_route,
+    same_route(_ordered) or different_route are taken out, then every node not on a route is inserted at its cheapest
+    allowed position, see insert_cheapest for feasible. Returns the routes and the number of nodes which had to be
+    (re)inserted.
+    """
+    depot = data['depot']
+    no_nodes = len(data['time_matrix'])
+    routes = [[node for node in route if node != depot and 0 <= node < no_nodes]
+              for route in routes[:data['num_vehicles']]]
+    routes += [[] for _ in range(data['num_vehicles'] - len(routes))]
+
+    drop_violations(routes, data)
+    placed = set(node for route in routes for node in route)
+    missing = [node for node in range(no_nodes) if node != depot and node not in placed]
+    for node in missing:
+        insert_cheapest(routes, node, data, feasible)
+    return routes, len(missing)
+
+
+def drop_violations(routes, data):
+    vehicle_of = vehicles_of(routes)
+    dropped = set()
+
+    for route_idx, route_assignment in enumerate(data['assign_to_route']):
+        dropped.update(node for node in route_assignment if vehicle_of.get(node, route_idx) != route_idx)
+
+    for group in list(data['same_route']) + list(data['same_route_ordered']):
+        vehicles = set(vehicle_of.get(node) for node in group)
+        positions = [routes[vehicle_of[node]].index(node) for node in group if node in vehicle_of]
+        if len(vehicles) > 1 or positions != sorted(positions):
+            dropped.update(group)
+
+    for node1, node2 in data['different_route']:
+        if node1 in vehicle_of and vehicle_of.get(node1) == vehicle_of.get(node2):
+            dropped.add(node2)
+
+    for route in routes:
+        route[:] = [node for node in route if node not in dropped]
+
+
+def insert_cheapest(routes, node, data, feasible=None):
+    """
+    Inserts node where it adds the least time, within the vehicles and positions its constraints allow. With
+    feasible, positions are tried cheapest first until feasible(route) holds for the route with node, the cheapest
+    one is taken if it never does. Returns whether node was inserted at a feasible position.
+    """
+    time = data['time_matrix']
+    depot = data['depot']
+    candidates = []
+    for vehicle, lo, hi in allowed_positions(routes, node, data):
+        path = np.array([depot] + routes[vehicle] + [depot])
+        # inserting at position p puts node between path[p] and path[p + 1]
+        added = time[path[:-1], node] + time[node, path[1:]] - time[path[:-1], path[1:]]
+        candidates += [(added[position], vehicle, position) for position in range(lo, hi + 1)]
+    if not candidates:
+        return False
+    candidates.sort(key=lambda candidate: candidate[0])
+    if feasible:
+        for _, vehicle, position in candidates:
+            if feasible(routes[vehicle][:position] + [node] + routes[vehicle][position:]):
+                routes[vehicle].insert(position, node)
+                return True
+    routes[candidates[0][1]].insert(candidates[0][2], node)
+    return not feasible
+
+
+def allowed_positions(routes, node, data):
+    """Yields (vehicle, first, last) insert positions for node."""
+    vehicles = set(range(len(routes)))
+    for route_idx, route_assignment in enumerate(data['assign_to_route']):
+        if node in route_assignment:
+            vehicles &= {route_idx}
+
+    vehicle_of = vehicles_of(routes)
+    for node1, node2 in data['different_route']:
+        partner = node2 if node == node1 else node1 if node == node2 else None
+        if partner in vehicle_of:
+            vehicles.discard(vehicle_of[partner])
+
+    bounds = {}
+    for group in list(data['same_route']) + list(data['same_route_ordered']):
+        if node not in group:
+            continue
+        order = group.index(node)
+        for other in group:
+            if other == node or other not in vehicle_of:
+                continue
+            vehicle = vehicle_of[other]
+            vehicles &= {vehicle}
+            lo, hi = bounds.get(vehicle, (0, len(routes[vehicle])))
+            position = routes[vehicle].index(other)
+            if group.index(other) < order:
+                lo = max(lo, position + 1)
+            else:
+                hi = min(hi, position)
+            bounds[vehicle] = (lo, hi)
+
+    for vehicle in sorted(vehicles):
+        lo, hi = bounds.get(vehicle, (0, len(routes[vehicle])))
+        if lo <= hi:
+            yield vehicle, lo, hi
+
+
+def vehicles_of(routes):
+    return dict((node, vehicle) for vehicle, route in enumerate(routes) for node in route)
@@ -0,0 +1,16 @@
+from functools import lru_cache
+
+from main.geocoding import LruGeocodeCache, RedisGeocodeCache
+from main.requests_util import make_coordinates_geocoder
+from main.worker.worker import conn
+
+
+def run_geocode_job(addresses, api_key):
+    coordinates_list, _ = coordinates_geocoder(api_key).geocode_all(addresses)
+    return [coordinates or {} for coordinates in coordinates_list]
+
+
+@lru_cache(maxsize=None)
+def coordinates_geocoder(api_key):
+    """One geocoder per process and api key, like the one of the web app."""
+    return make_coordinates_geocoder(api_key, LruGeocodeCache(RedisGeocodeCache(conn)))
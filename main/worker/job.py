@@ -1,84 +1,108 @@
-import datetime
-import smtplib
-from email.message import EmailMessage
+import time
+from functools import partial
 
+from rq import get_current_job
+
+from main.events import publish_event, publish_status
+from main.matrix_cache import MatrixCache
+from main.presolve import InfeasibleConstraints
+from main.profiling import profiling_requested, start_profiler, store_profile
+from main.progress import JobProgress
+from main.replan import replan_runner
 from main.requests_util import request_dist_matrix
+from main.result_store import store_result, result_key
 from main.run_algorithm import mainrunner
-from main.template import render
-import sendgrid
-import os
-from sendgrid.helpers.mail import *
+from main.scheduling import RUN_MAIL_JOB, RUN_ERROR_MAIL_JOB, record_duration, enqueue_mail
+from main.telemetry import timed, job_telemetry, record_job
+from main.worker.worker import conn
 
 
-def run_job(address_json, constrains_json, config, mail_to, api_key, template_html):
+def run_job(address_json, constrains_json, config, mail_to, api_key, template_html, runner=mainrunner,
+            matrix_cache=None):
+    """Solves and stores the routes, then leaves mailing them, or the error, to a job on the mail queue."""
+    started = time.time()
+    phases = {}
+    profiler = start_profiler() if profiling_requested(constrains_json) else None
+    job = get_current_job()
+    if job:
+        publish_status(conn, job.id, 'running')
     try:
-        return run(address_json, api_key, config, constrains_json, mail_to, template_html)
+        json_routes = run(address_json, api_key, constrains_json, phases, runner, matrix_cache)
     except Exception as e:
-        send_mail(config, "", mail_to, str(e))
+        finish_job(profiler, started, phases, 'failed', error=e)
+        if job:
+            enqueue_mail(conn, RUN_ERROR_MAIL_JOB, (job.id, config, mail_to, str(e)))
+        return None
+    result = finish_job(profiler, started, phases, 'finished', json_routes)
+    if job:
+        enqueue_mail(conn, RUN_MAIL_JOB, (job.id, config, mail_to, constrains_json['planningType'], template_html))
+    return result
 
 
-def run(address_json, api_key, config, constrains_json, mail_to, template_html):
-    planning_type = constrains_json['planningType']
-    print("----> Job running " + planning_type)
-    dist_matrix_json = request_dist_matrix(address_json, api_key, planning_type)
-    json_routes = mainrunner(dist_matrix_json, constrains_json, address_json)
-    routes_html = [render(json_route, template_html, planning_type) for json_route in json_routes]
-    send_mail(config, json_routes, mail_to, routes_html)
-    return json_routes
+def run_replan_job(address_json, constrains_json, config, mail_to, api_key, template_html, new_nodes,
+                   improve_timeout):
+    """
+    Inserts the new_nodes into the routes of an earlier job in constrains_json['initial_routes'], see main.replan.
+    While the matrix of the earlier job is cached, only the rows and columns of the new addresses are fetched,
+    otherwise the whole matrix, which statistics['replan']['matrix'] records.
+    """
+    matrix_cache = MatrixCache(conn, min_overlap=0)
+    runner = partial(replan_runner, new_nodes=new_nodes, improve_timeout=improve_timeout, matrix_cache=matrix_cache)
+    return run_job(address_json, constrains_json, config, mail_to, api_key, template_html, runner, matrix_cache)
 
 
-def send_mail(config, json_routes, mail_to, routes_html):
-    if config.get('MAIL_TYPE') == 'gmail':
-        return send_gmail_email(config, json_routes, mail_to, routes_html)
-    return send_sendgrid(config, mail_to, routes_html)
-
-
-def send_sendgrid(config, mail_to, json_routes):
-    apikey = config['SENDGRID_API_KEY']
-    sg = sendgrid.SendGridAPIClient(apikey=apikey)
-    from_email = config['MAIL_USERNAME']
-    email = Email(from_email)
-    subject = "Route Planning"
-    to_email = Email(mail_to)
-    content = Content("text/plain", str(json_routes))
-    mail = Mail(email, subject, to_email, content)
-    print("Sendgrid..." + str(apikey) + " " + str(mail_to) + " " + str(from_email))
-    try:
-        response = sg.client.mail.send.post(request_body=mail.get())
-        return {'routes': json_routes, 'mail_status': response.status_code}
-    except Exception as e:
-        raise e
+def finish_job(profiler, started, phases, status, json_routes=None, error=None):
+    """
+    Stores profile, routes, run time and telemetry of the job. Returns what rq keeps as job result: the size and
+    location of the stored routes, or the routes themselves when not running as job. Without routes the job is
+    failed, which goes to job.meta['status'] with the error, as rq sees the job finish.
+    """
+    if profiler and get_current_job():
+        store_profile(conn, get_current_job().id, profiler)
+        update_meta({'profiled': True})
+    job = get_current_job()
+    record_job(conn, job_telemetry(job.meta if job else {}, phases, status))
+    if not job:
+        return json_routes
+    record_duration(conn, job.origin, time.time() - started)
+    if json_routes is None:
+        update_meta({'status': 'failed', 'error_message': str(error)})
+        publish_status(conn, job.id, 'failed')
+        return None
+    store_result(conn, job.id, job.meta, json_routes)
+    publish_status(conn, job.id, 'completed')
+    return {'result_key': result_key(job.id), 'num_routes': len(json_routes)}
 
 
-def send_gmail_email(config, json_routes, mail_to, routes_html):
-    msg = EmailMessage()
-    msg['From'] = config['MAIL_USERNAME']
-    msg['To'] = mail_to
-    msg['Subject'] = 'Route Planning'
-    message = """Send at {} \n content {}""".format(datetime.datetime.now(), routes_html)
-    msg.set_content(message)
+def run(address_json, api_key, constrains_json, phases=None, runner=mainrunner, matrix_cache=None):
+    """Solves the routes with runner, the wall time of every phase goes to phases and job.meta['phases']."""
+    phases = {} if phases is None else phases
+    planning_type = constrains_json['planningType']
+    print("----> Job running " + planning_type)
+    matrix_cache = matrix_cache or MatrixCache(conn)
+    with timed(phases, 'matrix_fetch'):
+        dist_matrix_json = request_dist_matrix(address_json, api_key, planning_type, matrix_cache)
+    update_meta({'matrix_cache': dict(matrix_cache.last_lookup, totals=matrix_cache.stats(),
+                                      matrix_size=len(address_json)),
+                 'phases': phases})
+    statistics = {}
+    job = get_current_job()
     try:
-        with make_server(config) as server:
-            if config.get('MAIL_PASSWORD'):
-                server.login(config['MAIL_USERNAME'], config.get('MAIL_PASSWORD'))
-            send_message = server.send_message(msg)
-            server.quit()
-            return {'routes': json_routes, 'mail_status': send_message}
-    except Exception as e:
-        raise e
-
-
-def make_server(config):
-    server = config['MAIL_SERVER']
-    port = config['MAIL_PORT']
-    if config.get('MAIL_USE_SSL'):
-        client = smtplib.SMTP_SSL(server, port)
-    else:
-        client = smtplib.SMTP(server, port)
+        with timed(phases, 'solve'):
+            json_routes = runner(dist_matrix_json, constrains_json, address_json, statistics,
+                                 JobProgress(job) if job else None)
+    except InfeasibleConstraints as e:
+        update_meta({'infeasible': e.reasons})
+        raise
+    phases.update(('solve.' + phase, seconds) for phase, seconds in statistics.get('phases', {}).items())
+    update_meta({'solver': statistics, 'phases': phases})
+    return json_routes
 
-    if config.get('MAIL_USE_TLS'):
-        client.ehlo()
-        client.starttls()
-        client.ehlo()
 
-    return client
+def update_meta(values):
+    """Merges values into job.meta and publishes them as meta event."""
+    job = get_current_job()
+    if job:
+        job.meta.update(values)
+        job.save_meta()
+        publish_event(conn, job.id, 'meta', values)
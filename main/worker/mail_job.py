@@ -0,0 +1,63 @@
+"""Mail jobs, delivering the routes or the error of a solver job once the solver worker is done with it."""
+import json
+import time
+
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from main.events import publish_event
+from main.mailer import compose, send_messages
+from main.result_store import load_export, update_result_meta
+from main.template import render_routes
+from main.worker.worker import conn
+
+
+def run_mail_job(job_id, config, mail_to, planning_type, template_html):
+    """Mails the html of the stored routes of the completed job job_id to mail_to, rendered once per job."""
+    routes_html = load_export(conn, job_id, 'routes_html',
+                              lambda json_routes: json.dumps(render_routes(json_routes, template_html, planning_type)))
+    if routes_html is None:
+        raise ValueError('No stored routes for the job ' + job_id)
+    return deliver(job_id, config, [compose(config, mail_to, json.loads(routes_html))])
+
+
+def run_error_mail_job(job_id, config, mail_to, error):
+    """Mails the error the job job_id failed with to mail_to."""
+    return deliver(job_id, config, [compose(config, mail_to, error)])
+
+
+def deliver(job_id, config, messages):
+    """
+    Sends the messages and records the outcome in job_id's meta['mail'] under the id of the mail job. A failure is
+    recorded as retrying, or as failed after the last retry, and raised for rq to retry the mail job.
+    """
+    mail_job = get_current_job()
+    delivery_id = mail_job.id if mail_job else 'mail'
+    attempts = 1
+    if mail_job:
+        attempts = mail_job.meta['attempts'] = mail_job.meta.get('attempts', 0) + 1
+        mail_job.save_meta()
+    start = time.time()
+    try:
+        statuses = send_messages(config, messages)
+    except Exception as e:
+        retrying = bool(mail_job and mail_job.retries_left)
+        record_delivery(job_id, delivery_id, {'status': 'retrying' if retrying else 'failed', 'attempts': attempts,
+                                              'error': str(e)})
+        raise
+    record_delivery(job_id, delivery_id, {'status': 'sent', 'attempts': attempts,
+                                          'seconds': round(time.time() - start, 3)})
+    return {'job_id': job_id, 'mail_status': [str(status) for status in statuses]}
+
+
+def record_delivery(job_id, delivery_id, delivery):
+    """Keeps the delivery in the meta and the stored result of the job and publishes it as mail event."""
+    try:
+        job = Job.fetch(job_id, connection=conn)
+    except NoSuchJobError:
+        return
+    job.meta.setdefault('mail', {})[delivery_id] = delivery
+    job.save_meta()
+    update_result_meta(conn, job_id, job.meta)
+    publish_event(conn, job_id, 'mail', dict(delivery, id=delivery_id))
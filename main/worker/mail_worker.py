@@ -0,0 +1,15 @@
+"""
+Delivers the mails of the mail queue. The jobs run in the worker process itself, without forking a work horse, so
+the SMTP connections of main.mailer are kept from one mail to the next. The scheduler enqueues the retries.
+
+Usage: python -m main.worker.mail_worker
+"""
+from rq import Queue, Connection, SimpleWorker
+
+from main.scheduling import MAIL_QUEUE
+from main.worker.worker import conn
+
+if __name__ == '__main__':
+    with Connection(conn):
+        worker = SimpleWorker([Queue(MAIL_QUEUE)])
+        worker.work(with_scheduler=True)
@@ -0,0 +1,99 @@
+"""
+Runs a pool of rq workers per host. The solver stack is imported once before the workers are forked, so neither the
+workers nor the work horses they fork per job import ortools again.
+
+Usage: python -m main.worker.pool [concurrency]
+"""
+import gc
+import importlib
+import os
+import signal
+import sys
+import time
+import traceback
+
+from rq import Queue, Connection
+
+from main.scheduling import worker_queue_layout
+from main.worker.heroku_rq_worker import Worker
+from main.worker.worker import conn
+
+PRELOAD_MODULES = ['ortools.constraint_solver.pywrapcp', 'main.run_algorithm', 'main.replan', 'main.worker.job',
+                   'main.worker.geocode_job']
+# all workers take these queues if set, by default the workers are split over the queues by worker_queue_layout
+WORKER_QUEUES = os.getenv('WORKER_QUEUES')
+RESPAWN_DELAY = 1.0
+
+
+def worker_concurrency():
+    """WORKER_CONCURRENCY workers, by default one per CPU."""
+    return int(os.getenv('WORKER_CONCURRENCY', 0)) or os.cpu_count() or 1
+
+
+def preload():
+    """Imports the solver stack and returns the seconds it took."""
+    start = time.time()
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+    # keep the preloaded objects out of garbage collections, which would copy their pages into every fork; python
+    # 3.6 of runtime.txt has no gc.freeze, there the forks share the pages until the first collection touches them
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return time.time() - start
+
+
+def spawn_worker(queue_names):
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        with Connection(conn):
+            Worker(list(map(Queue, queue_names))).work()
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+
+def queue_layout(concurrency):
+    if WORKER_QUEUES:
+        return [WORKER_QUEUES.split(',')] * concurrency
+    return worker_queue_layout(concurrency)
+
+
+def run_pool(layout):
+    """Keeps a worker running for each list of queue names in layout until SIGTERM or SIGINT, which is passed on to
+    the workers."""
+    stopping = []
+    workers = dict((spawn_worker(queue_names), queue_names) for queue_names in layout)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        queue_names = workers.pop(pid, None)
+        if queue_names and not stopping:
+            print("----> Worker {} exited with status {}, restarting".format(pid, status))
+            time.sleep(RESPAWN_DELAY)
+            workers[spawn_worker(queue_names)] = queue_names
+
+
+if __name__ == '__main__':
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else worker_concurrency()
+    layout = queue_layout(concurrency)
+    print("----> Preloaded solver stack in {:.2f}s, starting {} workers on {}".format(
+        preload(), concurrency, ' '.join(','.join(queue_names) for queue_names in layout)))
+    run_pool(layout)
@@ -3,6 +3,7 @@ import os
 import redis
 from rq import Queue, Connection
 
+from main.scheduling import worker_queue_layout
 from main.worker.heroku_rq_worker import Worker
 
 redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
@@ -11,5 +12,5 @@ conn = redis.from_url(redis_url)
 
 if __name__ == '__main__':
     with Connection(conn):
-        worker = Worker(list(map(Queue, ['default'])))
+        worker = Worker(list(map(Queue, worker_queue_layout(1)[0])))
         worker.work()